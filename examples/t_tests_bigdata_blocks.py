@@ -54,6 +54,17 @@ tvals, pvals, dfs = muols.t_test(contrasts=contrasts,
 print time4 - time3
 del muols
 
+# univariate analysis: fit by blocks sized from the available memory
+muols = MUOLS(Y=Y_memmap, X=X)
+time13 = time.time()
+muols.fit(block="auto")
+time14 = time.time()
+tvals, pvals, dfs = muols.t_test(contrasts=contrasts,
+                                 pval=True,
+                                 two_tailed=True)
+print time14 - time13
+del muols
+
 # univariate analysis: fit in one go
 muols = MUOLS(Y=Y_memmap, X=X)
 time5 = time.time()
@@ -7,6 +7,12 @@ Created on Fri Jun 14 19:38:46 2013
 
 from .models import MUPairwiseCorr
 from .models import MUOLS
+from .models import merge_maxT
+from .models import clear_designs_cache
+from .permutations import PermutationSet
 
 __all__ = ['MUPairwiseCorr',
-           'MUOLS']
+           'MUOLS',
+           'merge_maxT',
+           'clear_designs_cache',
+           'PermutationSet']
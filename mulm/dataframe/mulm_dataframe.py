@@ -8,9 +8,12 @@ Created on Sun Nov 16 12:09:43 2014
 import numpy as np
 import pandas as pd
 import statsmodels.api as sm
-from patsy import dmatrices
+from patsy import dmatrices, dmatrix
 from collections import OrderedDict
 from statsmodels.sandbox.stats.multicomp import multipletests
+from sklearn.utils import check_random_state
+from mulm.models import MUOLS, _permuted_tstats
+from mulm.utils import block_slices, iter_blocks, LRUCache
 
 class MULM:
     """ Massive (application) of Univariate Linear Model on panda DataFrame.
@@ -34,6 +37,12 @@ class MULM:
     model. If None no such statistics are computed/stored. Warning if not
     None this slows dwn the execution speed.
 
+    cache_size: int, maximum number of design matrices (per right-hand side)
+    and of their factorizations (per right-hand side and rows kept) cached
+    across the calls to t_test() and t_test_maxT(). The least recently used
+    are evicted first. See cache_info(). The caches are cleared when data is
+    replaced, call clear_cache() after modifying data in place.
+
     Return
     ------
     DataFrame with columns:
@@ -41,74 +50,61 @@ class MULM:
     "pvalue", "df".
     """
 
-    def __init__(self, data, formulas, intercept=True):
+    def __init__(self, data, formulas, intercept=True, cache_size=128):
         self.data = data
         self.formulas = formulas
         self.intercept = intercept
+        self.designs_cache = LRUCache(cache_size)
+        self.factorizations_cache = LRUCache(cache_size)
+        self._cached_data = data
         #self.regressors = regressors
         #self.covar_models = covar_models
         #self.out_filemane = out_filemane
 
     def t_test(self, contrasts=None, out_filemane=None, anova=False):
-        # Make sure contrasts is a list of list
-        if contrasts is not None:
-            if isinstance(contrasts, tuple):
-                contrasts = list(contrasts)
-            if not isinstance(contrasts, list):
-                contrasts = [contrasts]
-            def change(c):
-                if isinstance(c, list): return c
-                else: return [c]
-            contrasts = [change(c) for c in contrasts]
+        """t-test the contrasts for all the formulas.
+
+        Formulas whose target is a numeric column of data are grouped by
+        right-hand side and rows kept (non missing target and covariates).
+        Each group is fitted at once by the mass-univariate MUOLS, over all
+        its targets. Other formulas (transformed targets, ...) or all of
+        them if out_filemane is given, are fitted by statsmodels OLS.
+        """
+        contrasts = self._check_contrasts(contrasts)
         if out_filemane:
             out_fd = open(out_filemane,'w')
-        #res_formulas, res_target, res_regressor, res_covariate = [], [], [], []
+        results = [None] * len(self.formulas)
+        if out_filemane:
+            designs, groups = dict(), OrderedDict()
+            others = range(len(self.formulas))
+        else:
+            designs, groups, others = self._groups()
+        for i in others:
+            results[i] = self._t_test_statsmodels(
+                self.formulas[i], contrasts, anova,
+                out_fd if out_filemane else None)
+        for (regressors, _), (formulas_idx, targets, kept) in groups.items():
+            X, rows = designs[regressors]
+            Y = self.data.iloc[rows[kept], targets].values.astype(float)
+            group_results = self._t_test_muols(X[kept], Y, contrasts, anova,
+                                               key=(regressors, kept))
+            for i, res in zip(formulas_idx, group_results):
+                results[i] = res
+        if out_filemane:
+            out_fd.close()
         res_formulas, res_target, res_contrasts = [], [], []
         res_effect, res_sd, res_tvalue, res_pvalue, res_df = [], [], [], [], []
-        for formula in self.formulas:
-            #formula = self.formulas[0]
+        for formula, res in zip(self.formulas, results):
             target, regressors = formula.split("~")
-            # fit
-            #dt = self.data[self.data[target].notnull()]
-            y, X = dmatrices(formula, data=self.data, return_type='dataframe')
-            if not self.intercept:
-                X = X.ix[:, 1:]
-            mod = sm.OLS(y, X)
-            sm_fitted = mod.fit()
-            if contrasts is not None and not anova:
-                #contrasts = [1]
-                if self.intercept:
-                    contrasts_ = [[0] + c for c in contrasts]
-                # pad with 0
-                contrasts_ = [c + [0] * (X.shape[1] - len(c)) for c in contrasts_]
-                #[0] + contrasts + [0] * (X.shape[1] - 2)
-                contrasts_str = ["_".join(X.columns[np.where(c)[0]].tolist())
-                    for c in contrasts_]
-                # TODO FIXME IF CONTRASTS AS A MATRIX
-                #contrasts_str = [X.columns[contrasts[i] != 0] for i in xrange(len(contrasts))]
-            else:
-                contrasts_ = np.identity(X.shape[1])
-                contrasts_str = X.columns.tolist()
-            #print contrasts_, formula, X.columns
-            sm_ttest = sm_fitted.t_test(contrasts_)
-            #
-            res_formulas += [formula] * len(contrasts_)
-            res_target += [target] * len(contrasts_)
+            contrasts_str, effect, sd, tvalue, pvalue, df = res
+            res_formulas += [formula] * len(contrasts_str)
+            res_target += [target] * len(contrasts_str)
             res_contrasts += contrasts_str
-            #res_covariate += covars
-            res_effect += sm_ttest.effect.ravel().tolist()
-            res_sd += sm_ttest.sd.ravel().tolist()
-            res_tvalue += sm_ttest.tvalue.ravel().tolist()
-            res_pvalue += sm_ttest.pvalue.ravel().tolist()
-            res_df += [sm_ttest.df_denom] * len(contrasts_)
-            if out_filemane:
-                out_fd.write("\n" + "=" * 78 + "\n")
-                out_fd.write("== Model:" + formula + "\n")
-                out_fd.write("=" * 78 + "\n")
-                out_fd.write(sm_fitted.summary().as_text())
-                out_fd.write("\n\n")
-        if out_filemane:
-            out_fd.close()
+            res_effect += effect
+            res_sd += sd
+            res_tvalue += tvalue
+            res_pvalue += pvalue
+            res_df += [df] * len(contrasts_str)
         o = OrderedDict()
         o["formula"] = res_formulas
         o["target"] = res_target
@@ -120,40 +116,302 @@ class MULM:
         o["df"] = res_df
         return pd.DataFrame(o)
 
-    def t_test_maxT(self, contrasts, nperm=100):#:, alternative= "two_sided"):
-        #alternatives = ["two_sided", "less", "greater", "one_sided_auto"]
-        #if not alternative in alternatives:
-        #    raise ValueError("Not a valid alternative")
-        data_ori = self.data
-        self.data = self.data.copy()
+    def _groups(self):
+        """Group the formulas whose target is a numeric column of data by
+        right-hand side and rows kept (non missing target and covariates).
+
+        Return
+        ------
+        designs: dict right-hand side => (X DataFrame, positions of the rows
+        of X in data)
+
+        groups: OrderedDict (right-hand side, kept rows) => (formulas
+        indices, targets columns positions, kept rows mask of X)
+
+        others: indices of the formulas that can not be grouped.
+        """
+        if self.data is not self._cached_data:
+            self.clear_cache()
+            self._cached_data = self.data
+        groups = OrderedDict()
+        designs = dict()
+        others = list()
+        data = None
+        notnull = self.data.notnull().values
+        columns = dict((col, j) for j, col in enumerate(self.data.columns))
+        for i, formula in enumerate(self.formulas):
+            target, regressors = formula.split("~")
+            if not self._batchable(target):
+                others.append(i)
+                continue
+            if regressors not in designs:
+                designs[regressors] = self.designs_cache.get(regressors)
+            if designs[regressors] is None:
+                if data is None:
+                    data = self._positional_data()
+                X = dmatrix(regressors, data=data, return_type='dataframe')
+                if not self.intercept:
+                    X = X.ix[:, 1:]
+                # X rows positions in data
+                designs[regressors] = X, np.asarray(X.index)
+                self.designs_cache.put(regressors, designs[regressors])
+            X, rows = designs[regressors]
+            kept = notnull[rows, columns[target.strip()]]
+            key = (regressors, kept.tostring())
+            if key not in groups:
+                groups[key] = (list(), list(), kept)
+            groups[key][0].append(i)
+            groups[key][1].append(columns[target.strip()])
+        return designs, groups, others
+
+    def _positional_data(self):
+        """Shallow copy of data indexed by the positions of its rows, which
+        identify the rows kept by patsy whatever the index of data (eg. with
+        duplicates)."""
+        data = self.data.copy(deep=False)
+        data.index = pd.RangeIndex(data.shape[0])
+        return data
+
+    def _muols(self, X, Y, key=None):
+        """MUOLS of Y on the design X (array) fitted, the factorization of
+        X being cached under key (right-hand side, kept rows mask)."""
+        mod = MUOLS(Y, X)
+        if key is not None:
+            key = (key[0], key[1].tostring())
+            design = self.factorizations_cache.get(key)
+            if design is not None:
+                mod._set_design(design)
+        mod.fit()
+        if key is not None and design is None:
+            self.factorizations_cache.put(key, mod._get_design())
+        return mod
+
+    def cache_info(self):
+        """Hits, misses, maxsize and currsize of the designs and
+        factorizations caches."""
+        return dict(designs=self.designs_cache.info(),
+                    factorizations=self.factorizations_cache.info())
+
+    def clear_cache(self):
+        self.designs_cache.clear()
+        self.factorizations_cache.clear()
+
+    def _check_contrasts(self, contrasts):
+        # Make sure contrasts is a list of list
+        if contrasts is not None:
+            if isinstance(contrasts, tuple):
+                contrasts = list(contrasts)
+            if not isinstance(contrasts, list):
+                contrasts = [contrasts]
+            def change(c):
+                if isinstance(c, list): return c
+                else: return [c]
+            contrasts = [change(c) for c in contrasts]
+        return contrasts
+
+    def _batchable(self, target):
+        """Whether target is a numeric column of data, hence can be fitted
+        by MUOLS together with other targets."""
+        target = target.strip()
+        return target in self.data.columns and \
+            np.issubdtype(self.data[target].dtype, np.number)
+
+    def _contrasts(self, contrasts, anova, X):
+        """Contrasts (padded with zeros for the covariates) and their names,
+        given the design matrix X."""
+        if contrasts is not None and not anova:
+            #contrasts = [1]
+            contrasts_ = contrasts
+            if self.intercept:
+                contrasts_ = [[0] + c for c in contrasts]
+            # pad with 0
+            contrasts_ = [c + [0] * (X.shape[1] - len(c)) for c in contrasts_]
+            #[0] + contrasts + [0] * (X.shape[1] - 2)
+            contrasts_str = ["_".join(X.columns[np.where(c)[0]].tolist())
+                for c in contrasts_]
+            # TODO FIXME IF CONTRASTS AS A MATRIX
+            #contrasts_str = [X.columns[contrasts[i] != 0] for i in xrange(len(contrasts))]
+        else:
+            contrasts_ = np.identity(X.shape[1])
+            contrasts_str = X.columns.tolist()
+        return contrasts_, contrasts_str
+
+    def _t_test_statsmodels(self, formula, contrasts, anova, out_fd=None):
+        """t-test of a single formula with statsmodels OLS.
+
+        Return
+        ------
+        contrasts_str, effect, sd, tvalue, pvalue (lists) and df
+        """
+        #dt = self.data[self.data[target].notnull()]
+        y, X = dmatrices(formula, data=self.data, return_type='dataframe')
+        if not self.intercept:
+            X = X.ix[:, 1:]
+        mod = sm.OLS(y, X)
+        sm_fitted = mod.fit()
+        contrasts_, contrasts_str = self._contrasts(contrasts, anova, X)
+        #print contrasts_, formula, X.columns
+        sm_ttest = sm_fitted.t_test(contrasts_)
+        if out_fd:
+            out_fd.write("\n" + "=" * 78 + "\n")
+            out_fd.write("== Model:" + formula + "\n")
+            out_fd.write("=" * 78 + "\n")
+            out_fd.write(sm_fitted.summary().as_text())
+            out_fd.write("\n\n")
+        return (contrasts_str,
+                sm_ttest.effect.ravel().tolist(),
+                sm_ttest.sd.ravel().tolist(),
+                sm_ttest.tvalue.ravel().tolist(),
+                sm_ttest.pvalue.ravel().tolist(),
+                sm_ttest.df_denom)
+
+    def _t_test_muols(self, X, Y, contrasts, anova, key=None):
+        """t-test of the formulas of the targets Y (columns) sharing the
+        design matrix X, fitted at once with MUOLS. The factorization of X is
+        cached under key (see _muols()).
+
+        Return
+        ------
+        list of (contrasts_str, effect, sd, tvalue, pvalue, df), one per
+        target.
+        """
+        contrasts_, contrasts_str = self._contrasts(contrasts, anova, X)
+        contrasts_ = np.atleast_2d(np.asarray(contrasts_, dtype=float))
+        mod = self._muols(X.values, Y, key)
+        tvalue, pvalue, df = mod.t_test(contrasts_, pval=True,
+                                        two_tailed=True)
+        effect = np.dot(contrasts_, mod.coef)
+        sd = np.sqrt(mod.err_ss / mod.df) * \
+            np.sqrt(mod._contrasts_var(contrasts_))[:, np.newaxis]
+        return [(contrasts_str, effect[:, j].tolist(), sd[:, j].tolist(),
+                 tvalue[:, j].tolist(), pvalue[:, j].tolist(), mod.df)
+                for j in xrange(Y.shape[1])]
+
+    def t_test_maxT(self, contrasts, nperm=100, perm_batch=100,
+                    random_state=None, permutations=None):
+        """t-test the contrasts for all the formulas (see t_test()) with
+        pvalues corrected for multiple comparisons by the maxT procedure.
+
+        All the targets are permuted with the same permutation of the rows of
+        data, restricted to the rows kept by each formula, which preserves
+        the dependence between the targets. The formulas are fitted by groups
+        sharing a design (see t_test()), formulas that can not be grouped
+        forming their own group. For each group, the design is parsed and
+        factorized once and the t-statistics of a batch of perm_batch
+        permutations are computed at once (see MUOLS.t_test_maxT()), only the
+        max and min t-values of each permutation being kept.
+
+        Parameters
+        ----------
+        contrasts: see t_test()
+
+        nperm: int
+            number of permutations
+
+        perm_batch: int
+            number of permutations tested at once
+
+        random_state: None, int or RandomState
+
+        permutations: mulm.PermutationSet
+            precomputed permutations of the rows of data, used instead of
+            random ones (nperm is then the size of the set). A permutation
+            is restricted to the rows kept by a formula by ordering them as
+            in the permutation. With exchangeability blocks, the kept rows of
+            each block are ordered this way and assigned to the kept rows of
+            the same block, which preserves the blocks.
+
+        Return
+        ------
+        DataFrame of t_test() with the additional columns
+        "pvalues_onesided_maxT", "pvalues_twosided_maxT" and
+        "pvalue_fdr_bh".
+        """
+        contrasts = self._check_contrasts(contrasts)
+        random_state = check_random_state(random_state)
+        if permutations is not None:
+            if permutations.n != self.data.shape[0] or \
+                    permutations.sign_flip:
+                raise ValueError('permutations must permute the rows of data')
+            nperm = len(permutations)
         stats = self.t_test(contrasts=contrasts, out_filemane=None)
-        tmax = list()
-        tmin = list()
-        targets = set([formula.split("~")[0] for formula in self.formulas])
-        for perm in xrange(nperm):
-            print "Perm ", perm
-            # permut all targets
-            for target in targets:
-                self.data[target] = np.random.permutation(self.data[target])
-            stats_p = self.t_test(contrasts=contrasts, out_filemane=None)
-            tmax.append(np.max(stats_p.tvalue))
-            tmin.append(np.min(stats_p.tvalue))
-        self.data = data_ori
-        self.tmax = np.array(tmax)
-        self.tmin = np.array(tmin)
-        self.tmax_2sided = np.max(np.abs(np.vstack([self.tmax, self.tmin])), axis=0)
-        pvalues_twosided_maxT = np.asarray([np.sum(self.tmax_2sided >= np.abs(t)) / float(len(self.tmax))
-                for t in stats.tvalue])
-        pvalues_onesided_maxT = list()
-        for t in stats.tvalue:
-            if t >= 0:
-                pvalues_onesided_maxT.append(np.sum(self.tmax >= t) / float(len(self.tmax)))
+        designs, groups, others = self._groups()
+        problems = list()  # X, Y, positions of their rows in data, key
+        for (regressors, _), (formulas_idx, targets, kept) in groups.items():
+            X, rows = designs[regressors]
+            Y = self.data.iloc[rows[kept], targets].values.astype(float)
+            problems.append((X[kept], Y, rows[kept], (regressors, kept)))
+        data = self._positional_data()
+        for i in others:
+            y, X = dmatrices(self.formulas[i], data=data,
+                             return_type='dataframe')
+            if not self.intercept:
+                X = X.ix[:, 1:]
+            problems.append((X, y.values, np.asarray(X.index), None))
+        models = list()
+        for X, Y, rows, key in problems:
+            contrasts_, _ = self._contrasts(contrasts, False, X)
+            contrasts_ = np.atleast_2d(np.asarray(contrasts_, dtype=float))
+            mod = self._muols(X.values, Y, key)
+            # blocks of the kept rows, grouped by block
+            blocks = None
+            if permutations is not None and permutations.blocks is not None:
+                blocks = permutations.blocks[rows]
+                blocks = blocks, np.argsort(blocks, kind='mergesort')
+            models.append((mod, contrasts_,
+                           mod._contrasts_var(contrasts_), rows, blocks))
+        tmax = np.empty(nperm)
+        tmin = np.empty(nperm)
+        for perms in block_slices(nperm, perm_batch):
+            perms = slice(perms.start, min(perms.stop, nperm))
+            b = perms.stop - perms.start
+            # random keys of the rows of data, shared by all the formulas
+            if permutations is None:
+                keys = random_state.rand(b, self.data.shape[0])
             else:
-                pvalues_onesided_maxT.append(np.sum(self.tmin <= t) / float(len(self.tmin)))
-        pvalues_onesided_maxT = np.asarray(pvalues_onesided_maxT)
-        print "n pval two sided != one sided", \
-            np.sum(pvalues_onesided_maxT != pvalues_twosided_maxT)
-        assert np.all(pvalues_onesided_maxT <= pvalues_twosided_maxT)
+                # rank of the rows in the permutations
+                keys = np.argsort(permutations.batch(perms.start, perms.stop),
+                                  axis=1)
+            tmax[perms] = -np.inf
+            tmin[perms] = np.inf
+            for mod, contrasts_, cvar, rows, blocks in models:
+                # Y[order] with order = argsort(keys) of the kept rows, is
+                # tested with X[argsort(order)]
+                if blocks is None:
+                    order = np.argsort(keys[:, rows], axis=1)
+                else:
+                    # within each block: the kept rows sorted by key (keys
+                    # being < n) go to the kept rows of the block
+                    codes, grouped = blocks
+                    order = np.empty((b, len(rows)), dtype=np.intp)
+                    order[:, grouped] = np.argsort(
+                        codes + keys[:, rows] / float(self.data.shape[0]),
+                        axis=1)
+                inv_order = np.argsort(order, axis=1)
+                max_cols = mod._perm_max_cols(b, contrasts_.shape[0])
+                for pp, Y_block in iter_blocks(mod.Y, max_cols):
+                    tvals = _permuted_tstats(Y_block, mod.X, mod.pinv,
+                                             inv_order, contrasts_, cvar,
+                                             mod.df)
+                    tvals = tvals.reshape(b, -1)
+                    np.maximum(tmax[perms], tvals.max(axis=1),
+                               out=tmax[perms])
+                    np.minimum(tmin[perms], tvals.min(axis=1),
+                               out=tmin[perms])
+                    del tvals
+        self.tmax = tmax
+        self.tmin = tmin
+        self.tmax_2sided = np.maximum(np.abs(tmax), np.abs(tmin))
+        tvalue = stats.tvalue.values
+        # number of permutations with a max >= t (or a min <= t)
+        nge = lambda t_perm, t: \
+            len(t_perm) - np.searchsorted(np.sort(t_perm), t, side='left')
+        pvalues_twosided_maxT = \
+            nge(self.tmax_2sided, np.abs(tvalue)) / float(nperm)
+        pvalues_onesided_maxT = np.where(
+            tvalue >= 0,
+            nge(tmax, tvalue),
+            nge(-tmin, -tvalue)) / float(nperm)
         stats["pvalues_onesided_maxT"] = pvalues_onesided_maxT
         stats["pvalues_twosided_maxT"] = pvalues_twosided_maxT
         stats["pvalue_fdr_bh"] = multipletests(stats.pvalue, method='fdr_bh')[1]
@@ -240,10 +498,9 @@ if __name__ == "__main__":
 
     #stats = model.t_test_maxT(nperm=10)
     #stats = model.t_test_maxT(nperm=10, alternative="less")
-    stats = model.t_test_maxT(contrasts=1, nperm=20, alternative="greater")
-    #stats = model.t_test_maxT(nperm=10, alternative="two_sided")
+    stats = model.t_test_maxT(contrasts=1, nperm=20)
     # Check that P (Positive) P_expected-20% < P < P_expected-20%
-    P = np.sum(stats.pvalue_maxT<0.05)
+    P = np.sum(stats.pvalues_twosided_maxT<0.05)
     assert (P <= py_info * (px_info)) and (P > 1)
 
 """
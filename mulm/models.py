@@ -4,16 +4,604 @@ Created on Tue Jun 25 13:25:41 2013
 
 @author: ed203246
 """
+import os
+import warnings
 import numpy as np
 import scipy
-from sklearn.preprocessing import scale
 from scipy import stats
+from scipy.sparse import coo_matrix, issparse
+from sklearn.utils import check_random_state
+from mulm.utils import block_slices, column_blocks, iter_blocks
+from mulm.utils import iter_row_blocks
+from mulm.utils import map_shared, share_array, open_shared_array
+from mulm.utils import effective_n_jobs
+from mulm.utils import available_memory, cache_size, LRUCache
+from mulm.permutations import PermutationSet, _index_dtype
+from collections import OrderedDict
+import hashlib
+
+# Factorizations of the designs (see _factorize()), shared by all the models
+# of the process, of at most 256Mo (see clear_designs_cache()).
+_designs_cache = LRUCache(
+    maxsize=32, maxbytes=2 ** 28,
+    sizeof=lambda design: design['pinv'].nbytes +
+    design['normalized_cov_params'].nbytes)
+
+
+def clear_designs_cache():
+    """Clear the cache of the factorizations of the designs shared by the
+    models of the process."""
+    _designs_cache.clear()
+
+
+def _factorize(X, cache=True):
+    """Design-only quantities of X, computed in float64: its pseudo-inverse
+    pinv, its rank, the degrees of freedom of the residuals df and
+    normalized_cov_params = pinv pinv' = (X'X)^-1.
+
+    X is factored by a QR decomposition with column pivoting X P = Q R.
+    When X has full column rank, pinv = P R^-1 Q' and (X'X)^-1 =
+    P R^-1 R^-1' P'. Rank deficient designs fall back on the SVD
+    (scipy.linalg.pinv).
+
+    The result is cached (see _designs_cache) under a hash of X if cache,
+    its arrays are read only.
+    """
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    if cache:
+        key = (X.shape, hashlib.sha1(X.view(np.uint8)).hexdigest())
+        design = _designs_cache.get(key)
+        if design is not None:
+            return design
+    n, p = X.shape
+    Q, R, perm = scipy.linalg.qr(X, mode='economic', pivoting=True)
+    diag = np.abs(np.diag(R))
+    tol = (diag[0] if len(diag) else 0) * max(n, p) * np.finfo(R.dtype).eps
+    rank = int(np.sum(diag > tol))
+    if rank == p:
+        R_inv = scipy.linalg.solve_triangular(R, np.identity(p))
+        pinv = np.empty((p, n))
+        pinv[perm] = np.dot(R_inv, Q.T)
+        normalized_cov_params = np.empty((p, p))
+        normalized_cov_params[np.ix_(perm, perm)] = np.dot(R_inv, R_inv.T)
+    else:
+        pinv = scipy.linalg.pinv(X)
+        # trace(X pinv) = trace(pinv X) = rank(X)
+        rank = int(np.round(np.trace(np.dot(pinv, X))))
+        normalized_cov_params = np.dot(pinv, pinv.T)
+    pinv.flags.writeable = False
+    normalized_cov_params.flags.writeable = False
+    design = dict(pinv=pinv, rank=rank, df=float(n - rank),
+                  normalized_cov_params=normalized_cov_params)
+    if cache:
+        _designs_cache.put(key, design)
+    return design
+
+def _permuted_tstats(Y_block, X, pinv, perms, contrasts, cvar, df,
+                     sign_flip=False):
+    """t-statistics of the contrasts for the regressions of Y_block on all
+    the permuted designs X[perm, :], perm in perms.
+
+    The pseudo-inverse of X[perm, :] is pinv[:, perm], so the coefficients
+    (and X'Y) of all the permutations are computed by a single matrix
+    product. If sign_flip, perms are (b, n) arrays of signs s and the
+    designs are diag(s) X, whose pseudo-inverse is pinv diag(s) (the
+    regression of diag(s) Y on X). The residual sum of squares is derived from
+    ||y - Hy||^2 = y'y - (X'y)'coef, accumulated in float64.
+
+    Parameters
+    ----------
+    Y_block: (n, m) array
+
+    X: (n, q) array, the design, of the same dtype as Y_block.
+
+    pinv: (q, n) array, pseudo-inverse of X, of the same dtype as Y_block.
+
+    perms: (b, n) array of permutation indices (or of +/-1 signs).
+
+    contrasts: (k, q) array
+
+    cvar: (k, ) array, diag(C pinv pinv' C')
+
+    df: degrees of freedom of the residuals.
+
+    Return
+    ------
+    tstats (b, k, m) array
+    """
+    b, n = perms.shape
+    q = X.shape[1]
+    m = Y_block.shape[1]
+    # With an intercept (in the span of X, and of all its permutations), the
+    # residuals of Y_block and of the centered Y_block are the same: center
+    # to avoid the cancellation of y'y - (X'y)'coef (mostly in float32).
+    # (the intercept is not in the span of sign-flipped designs)
+    ones_coef = np.sum(pinv, axis=1)
+    centered = not sign_flip and np.allclose(np.dot(X, ones_coef), 1)
+    if centered:
+        Y_mean = np.mean(Y_block, axis=0, dtype=np.float64).astype(
+            Y_block.dtype)
+        Y_block = Y_block - Y_mean
+    if sign_flip:
+        signs = perms.astype(pinv.dtype)[:, np.newaxis, :]
+        pinv_perms = (pinv[np.newaxis] * signs).reshape(b * q, n)
+        Xt_perms = (X.T[np.newaxis] * signs).reshape(b * q, n)
+        del signs
+    else:
+        pinv_perms = pinv[:, perms].transpose(1, 0, 2).reshape(b * q, n)
+        Xt_perms = X.T[:, perms].transpose(1, 0, 2).reshape(b * q, n)
+    coef = np.dot(pinv_perms, Y_block).reshape(b, q, m)
+    XtY = np.dot(Xt_perms, Y_block).reshape(b, q, m)
+    del pinv_perms, Xt_perms
+    err_ss = np.sum(Y_block ** 2, axis=0, dtype=np.float64) - \
+        np.sum(coef * XtY, axis=1, dtype=np.float64)
+    del XtY
+    if centered:
+        coef += ones_coef[np.newaxis, :, np.newaxis] * Y_mean
+    # (k, b, m) => (b, k, m)
+    cbeta = np.tensordot(contrasts.astype(coef.dtype), coef,
+                         axes=([1], [1])).transpose(1, 0, 2)
+    del coef
+    std_cbeta = np.sqrt(err_ss[:, np.newaxis, :] / df *
+                        cvar[np.newaxis, :, np.newaxis])
+    return cbeta / std_cbeta.astype(cbeta.dtype)
+
+
+def _permutation_shards(nperms, perm_batch, random_state=None,
+                        permutations=None):
+    """Split nperms permutations into shards of perm_batch permutations,
+    each with its own seed drawn from random_state, or taken from the
+    PermutationSet permutations (in place of the seed).
+
+    The permutations only depend on random_state, not on the way the shards
+    are distributed among the workers.
+
+    Return
+    ------
+    list of (start, stop, seed)
+    """
+    starts = range(0, nperms, perm_batch)
+    if permutations is not None:
+        return [(start, min(start + perm_batch, nperms), permutations)
+                for start in starts]
+    random_state = check_random_state(random_state)
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=len(starts))
+    return [(start, min(start + perm_batch, nperms), seed)
+            for start, seed in zip(starts, seeds)]
+
+
+def _check_permutations(permutations, n, nperms, sign_flip=False):
+    """nperms, or the size of the PermutationSet permutations of n rows."""
+    if permutations is None:
+        return nperms
+    if permutations.n != n:
+        raise ValueError('the permutations are not permutations of the %i '
+                         'rows' % n)
+    if permutations.sign_flip != sign_flip:
+        raise ValueError('sign flips and permutations can not be mixed')
+    return len(permutations)
+
+
+def _shard_permutations(n, shard):
+    """(stop - start, n) array of the permutations of the shard, of the
+    compact dtype of the indices of n rows (see PermutationSet)."""
+    start, stop, seed = shard
+    if isinstance(seed, PermutationSet):
+        return seed.batch(start, stop)
+    random_state = np.random.RandomState(seed)
+    return np.array([random_state.permutation(n)
+                     for i in xrange(stop - start)], dtype=_index_dtype(n))
+
+
+def _inverse_permutations(perms):
+    """Inverses of the (b, n) permutations perms, of the same dtype."""
+    inverses = np.empty_like(perms)
+    inverses[np.arange(perms.shape[0])[:, np.newaxis], perms] = \
+        np.arange(perms.shape[1])
+    return inverses
+
+
+def _sequential_rounds(shards, first=100):
+    """Split the shards into rounds ending after first, 2 first, 4 first...
+    permutations (the last round ends with the last shard)."""
+    rounds = [[]]
+    stop = first
+    for shard in shards:
+        rounds[-1].append(shard)
+        if shard[1] >= stop:
+            rounds.append([])
+            while stop <= shard[1]:
+                stop *= 2
+    return [shards_ for shards_ in rounds if shards_]
+
+
+def _chunks(shards, size):
+    """Split the shards into chunks of at least size permutations."""
+    chunks = [[]]
+    for shard in shards:
+        if chunks[-1] and shard[0] - chunks[-1][0][0] >= size:
+            chunks.append([])
+        chunks[-1].append(shard)
+    return [chunk for chunk in chunks if chunk]
+
+
+def _maxT_state(shards, nperms, perm_range, contrasts, two_tailed,
+                sign_flip, tvals, df):
+    """Description of a maxT run stored in its checkpoints: a run resumes
+    (or merges) only checkpoints of the same permutations and tests."""
+    permutations = [shard[2] for shard in shards
+                    if isinstance(shard[2], PermutationSet)]
+    return dict(starts=np.array([shard[0] for shard in shards]),
+                stops=np.array([shard[1] for shard in shards]),
+                # -1 for the shards of a PermutationSet, identified by its
+                # digest
+                seeds=np.array([-1 if isinstance(shard[2], PermutationSet)
+                                else shard[2] for shard in shards]),
+                permutations=permutations[0].digest() if permutations
+                else "",
+                nperms=nperms, perm_range=np.array(perm_range),
+                contrasts=contrasts, two_tailed=two_tailed,
+                sign_flip=sign_flip, tvals=tvals, df=df)
+
+
+def _save_checkpoint(filename, state, max_t, cursor):
+    """Atomically (write and rename) save a maxT checkpoint: the max-t of
+    the permutations done, up to cursor, and the state of the run."""
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'wb') as fd:
+        np.savez(fd, max_t=max_t, cursor=cursor, **state)
+        fd.flush()
+        os.fsync(fd.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def _load_checkpoint(filename, state=None):
+    """Load a maxT checkpoint, checking that it was saved by a run of the
+    given state (except for the permutations range if state has no
+    perm_range).
+
+    Return
+    ------
+    max_t, cursor, state of the checkpoint
+    """
+    with np.load(filename) as data:
+        saved = dict((key, data[key]) for key in data.files)
+    max_t, cursor = saved.pop("max_t"), int(saved.pop("cursor"))
+    for key, value in (state or dict()).items():
+        value = np.asarray(value)
+        if key not in saved:
+            same = False
+        elif key == "tvals":
+            same = value.shape == saved[key].shape and \
+                np.allclose(value, saved[key])
+        else:
+            same = value.shape == saved[key].shape and \
+                np.all(value == saved[key])
+        if not same:
+            raise ValueError('%s is a checkpoint of another permutation '
+                             'run (%s differs)' % (filename, key))
+    return max_t, cursor, saved
+
+
+def merge_maxT(filenames):
+    """Merge the checkpoints of maxT runs of MUOLS.t_test_maxT() over
+    complementary permutation ranges (perm_range) into the corrected
+    p-values of the whole run, identical to those of a single run.
+
+    Parameters
+    ----------
+    filenames: list of the checkpoint files of the runs.
+
+    Return
+    ------
+    tstats (k, p) array, pvals (k, p) array, df (k,) array
+
+    Example
+    -------
+    >>> import numpy as np
+    >>> import mulm
+    >>> X = np.random.randn(100, 5)
+    >>> Y = np.random.randn(100, 10)
+    >>> mod = mulm.MUOLS(Y, X).fit()
+    >>> for start in range(0, 1000, 500):
+    ...     _ = mod.t_test_maxT(np.identity(5), nperms=1000, random_state=0,
+    ...                         perm_range=(start, start + 500),
+    ...                         checkpoint="maxT_%i.npz" % start)
+    >>> tvals, pvals, df = mulm.merge_maxT(["maxT_0.npz", "maxT_500.npz"])
+    """
+    runs = list()
+    state = None
+    for filename in filenames:
+        max_t, cursor, saved = _load_checkpoint(filename, state)
+        start, stop = saved.pop("perm_range")
+        if cursor != stop:
+            raise ValueError('%s is the checkpoint of an unfinished run'
+                             % filename)
+        state = saved
+        runs.append((start, stop, max_t))
+    runs.sort(key=lambda run: run[0])
+    if [run[0] for run in runs] != [0] + [run[1] for run in runs[:-1]] or \
+            runs[-1][1] != int(state["nperms"]):
+        raise ValueError('the permutation ranges do not cover the %i '
+                         'permutations' % int(state["nperms"]))
+    max_t = np.vstack([run[2] for run in runs])
+    tvals = state["tvals"]
+    tvals_ = np.abs(tvals) if state["two_tailed"] else tvals
+    pvalues = np.array(
+        [(max_t.shape[0] -
+          np.searchsorted(np.sort(max_t[:, con]), tvals_[con, :]))
+         / float(max_t.shape[0]) for con in xrange(tvals.shape[0])])
+    return tvals, pvalues, state["df"]
+
+
+def _clopper_pearson(count, nperms, confidence):
+    """Clopper-Pearson confidence interval of the probability of the count
+    exceedances observed in nperms permutations."""
+    tail = (1 - confidence) / 2.
+    count = np.asarray(count, dtype=float)
+    lower = np.where(count > 0, stats.beta.ppf(
+        tail, np.maximum(count, 1), nperms - count + 1), 0.)
+    upper = np.where(count < nperms, stats.beta.ppf(
+        1 - tail, count + 1, np.maximum(nperms - count, 1)), 1.)
+    return lower, upper
+
+
+def _gpd_pvalues(null, values, min_count=10, n_exceedances=250,
+                 gof_alpha=0.05):
+    """Permutation p-values of values given the null sample, those with less
+    than min_count exceedances being estimated from a generalized Pareto
+    distribution (GPD) fitted to the upper tail of null (Knijnenburg et al.
+    2009).
+
+    The GPD is fitted to the n_exceedances largest values of null (at most
+    a quarter of them) above the threshold u between them and the others:
+    p = n_exceedances / nperms * GPD.sf(value - u). If the Kolmogorov-Smirnov
+    goodness-of-fit test rejects the fit at gof_alpha, n_exceedances is
+    decreased by 10 down to 20, after what the empirical p-values are kept.
+
+    Return
+    ------
+    pvals (same shape as values), fit (n_exceedances, shape, scale,
+    goodness-of-fit pvalue), or None if not used or rejected.
+    """
+    null = np.sort(null)
+    nperms = len(null)
+    values = np.asarray(values)
+    pvals = (nperms - np.searchsorted(null, values)) / float(nperms)
+    tail = pvals * nperms < min_count
+    n_exc = min(n_exceedances, nperms // 4)
+    if not np.any(tail):
+        return pvals, None
+    while n_exc >= 20:
+        u = (null[-n_exc - 1] + null[-n_exc]) / 2.
+        exceedances = null[-n_exc:] - u
+        with np.errstate(all='ignore'):
+            shape, _, scale = stats.genpareto.fit(exceedances, floc=0)
+            gof = stats.kstest(exceedances, 'genpareto',
+                               args=(shape, 0, scale))[1]
+        if gof > gof_alpha:
+            pvals[tail] = n_exc / float(nperms) * stats.genpareto.sf(
+                values[tail] - u, shape, 0, scale)
+            return pvals, (n_exc, shape, scale, gof)
+        n_exc -= 10
+    return pvals, None
+
+
+def _shard_signs(n, shard):
+    """(stop - start, n) array of the random +/-1 sign flips of the shard."""
+    start, stop, seed = shard
+    if isinstance(seed, PermutationSet):
+        return seed.batch(start, stop)
+    random_state = np.random.RandomState(seed)
+    return random_state.randint(2, size=(stop - start, n)).astype(np.int8) \
+        * 2 - 1
+
+
+def _split(seq, n_jobs):
+    """Split seq into (at most) effective_n_jobs(n_jobs) contiguous parts."""
+    n_parts = min(effective_n_jobs(n_jobs), len(seq))
+    return [seq[i * len(seq) // n_parts:(i + 1) * len(seq) // n_parts]
+            for i in xrange(n_parts)]
+
+
+def _split_blocks(Y, max_cols, n_jobs):
+    """Split the columns of Y into (at most) effective_n_jobs(n_jobs)
+    contiguous slices made of whole blocks (see column_blocks())."""
+    return [slice(part[0].start, part[-1].stop)
+            for part in _split(column_blocks(Y, max_cols), n_jobs)]
+
+
+def _maxT_shards(Y, X, pinv, shards, contrasts, cvar, df, two_tailed,
+                 max_cols, sign_flip=False):
+    """Max (|t| if two_tailed) over the columns of Y, of the t-statistics of
+    the permutations (sign flips if sign_flip) of the shards. Y is read
+    once, by blocks of max_cols columns.
+
+    Return
+    ------
+    max_t (nperms, k) array, nperms the total of the shards permutations.
+    """
+    shard_perms = _shard_signs if sign_flip else _shard_permutations
+    perms = [shard_perms(X.shape[0], shard) for shard in shards]
+    offsets = np.cumsum([0] + [len(perm) for perm in perms])
+    max_t = np.zeros((offsets[-1], contrasts.shape[0]))
+    max_t.fill(-np.inf)
+    for pp, Y_block in iter_blocks(Y, max_cols):
+        for perm, start, stop in zip(perms, offsets[:-1], offsets[1:]):
+            tvals_perm = _permuted_tstats(Y_block, X, pinv, perm,
+                                          contrasts, cvar, df, sign_flip)
+            if two_tailed:
+                tvals_perm = np.abs(tvals_perm)
+            np.maximum(max_t[start:stop], np.max(tvals_perm, axis=2),
+                       out=max_t[start:stop])
+    return max_t
+
+
+def _count_greater_equal(a):
+    """For all a[i, j], the number of elements of the column a[:, j] that are
+    greater than or equal to a[i, j]. Ties are handled by sorting the
+    columns.
+    """
+    n = a.shape[0]
+    order = np.argsort(a, axis=0, kind='mergesort')
+    a_sorted = np.take_along_axis(a, order, axis=0)
+    # position of the first element of each group of ties
+    first = np.zeros(a.shape, dtype=np.intp)
+    pos = np.arange(n)[:, np.newaxis]
+    first[1:] = np.where(a_sorted[1:] != a_sorted[:-1], pos[1:], 0)
+    np.maximum.accumulate(first, axis=0, out=first)
+    count = np.empty(a.shape, dtype=np.intp)
+    np.put_along_axis(count, order, n - first, axis=0)
+    return count
+
+
+def _rank_columns(a):
+    """Ranks (from 1) of the elements of each column of a, ties being given
+    the average of their ranks (as scipy.stats.rankdata()). Ties are handled
+    by sorting the columns.
+    """
+    n = a.shape[0]
+    order = np.argsort(a, axis=0, kind='mergesort')
+    a_sorted = np.take_along_axis(a, order, axis=0)
+    pos = np.arange(n)[:, np.newaxis]
+    new_group = a_sorted[1:] != a_sorted[:-1]
+    # positions of the first and of the last element of each group of ties
+    first = np.zeros(a.shape, dtype=np.intp)
+    first[1:] = np.where(new_group, pos[1:], 0)
+    np.maximum.accumulate(first, axis=0, out=first)
+    last = np.empty(a.shape, dtype=np.intp)
+    last[-1] = n - 1
+    last[:-1] = np.where(new_group, pos[:-1], n - 1)
+    last = np.minimum.accumulate(last[::-1], axis=0)[::-1]
+    ranks = np.empty(a.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2. + 1, axis=0)
+    return ranks
+
+
+def _minP_columns(Y, X, pinv, shards, columns, contrasts, cvar, df,
+                  two_tailed, max_cols):
+    """Min over the given columns of Y of the permutation p-values of each
+    permutation (but the last one) of the shards.
+
+    The columns are processed by blocks of max_cols: the t-statistics of all
+    the permutations of a block are computed with _permuted_tstats() (Y[perm]
+    on X is X[perm^-1] on Y) and ranked by sorting.
+
+    Return
+    ------
+    min_p (k, nperms) array
+    """
+    # Y[perm] on X is X[perm^-1] on Y: the inverses, the same for all blocks
+    perms = [_inverse_permutations(_shard_permutations(X.shape[0], shard))
+             for shard in shards]
+    offsets = np.cumsum([0] + [len(perm) for perm in perms])
+    nperms = offsets[-1] - 1
+    min_p = np.ones((contrasts.shape[0], nperms))
+    for pp, Y_block in iter_blocks(Y, max_cols, columns.start, columns.stop):
+        tvals_perm = np.empty((nperms + 1, contrasts.shape[0],
+                               Y_block.shape[1]))
+        for perm, start, stop in zip(perms, offsets[:-1], offsets[1:]):
+            tvals_perm[start:stop] = _permuted_tstats(
+                Y_block, X, pinv, perm, contrasts, cvar, df)
+        if two_tailed:
+            np.abs(tvals_perm, out=tvals_perm)
+        for con in xrange(contrasts.shape[0]):
+            # p-value of each permutation among the other permutations
+            pval_perm = (_count_greater_equal(tvals_perm[:, con, :])[:nperms]
+                         - 1) / float(nperms)
+            np.minimum(min_p[con], np.min(pval_perm, axis=1), out=min_p[con])
+    return min_p
+
+
+def _column_stats(A, max_cols, rank=False):
+    """Mean and standard deviation (1 for constant columns, as
+    sklearn.preprocessing.scale()) of the columns of A (of their ranks if
+    rank), by blocks."""
+    mean = np.zeros(A.shape[1])
+    std = np.zeros(A.shape[1])
+    for pp, A_block in iter_blocks(A, max_cols):
+        A_block = np.asarray(A_block, dtype=np.float64)
+        if rank:
+            A_block = _rank_columns(A_block)
+        mean[pp] = np.mean(A_block, axis=0)
+        std[pp] = np.std(A_block, axis=0)
+    std[std == 0] = 1
+    return mean, std
+
+
+def _standardize(A_block, mean, std, dtype):
+    """(A_block - mean) / std computed in float64, cast to dtype."""
+    A_block = np.asarray(A_block, dtype=np.float64) - mean
+    A_block /= std
+    return A_block.astype(dtype, copy=False)
+
+
+def _corr_maxT_columns(A, B, columns, shards, A_stats, B_stats, two_tailed,
+                       width, dtype, rank_A=False, rank_B=False):
+    """Max (|r| if two_tailed) over the pairs of columns of A[:, columns]
+    and B, of the correlations of all the permutations of the rows of B
+    given by the shards.
+
+    A and B are standardized by tiles of width columns (A_stats and B_stats
+    being the (mean, std) of their columns), after being ranked if rank_A
+    (rank_B). For a tile of B, the
+    correlations of a shard of b permutations are a single product of the
+    (b * width, n) stacked permuted tiles with the tile of A.
+
+    Return
+    ------
+    max_corr (nperms, ) array
+    """
+    n = A.shape[0]
+    nperms = shards[-1][1]
+    max_corr = np.empty(nperms)
+    max_corr.fill(-np.inf)
+    # the same permutations for all the tiles: generated once
+    shards_perms = [(shard[0], shard[1], _shard_permutations(n, shard))
+                    for shard in shards]
+    for aa, A_block in iter_blocks(A, width, columns.start, columns.stop):
+        if rank_A:
+            A_block = _rank_columns(A_block)
+        As = _standardize(A_block, A_stats[0][aa], A_stats[1][aa], dtype)
+        for bb, B_block in iter_blocks(B, width):
+            if rank_B:
+                B_block = _rank_columns(B_block)
+            Bs = _standardize(B_block, B_stats[0][bb], B_stats[1][bb], dtype)
+            for start, stop, perms in shards_perms:
+                Bs_perms = Bs[perms].transpose(0, 2, 1).reshape(
+                    (stop - start) * Bs.shape[1], n)
+                corr = np.dot(Bs_perms, As).reshape(stop - start, -1)
+                del Bs_perms
+                corr /= n
+                if two_tailed:
+                    np.abs(corr, out=corr)
+                np.maximum(max_corr[start:stop], corr.max(axis=1),
+                           out=max_corr[start:stop])
+                del corr
+    return max_corr
+
 
 class MUPairwiseCorr:
     """Mass-univariate pairwise correlations. Given two arrays X [n_samples x p]
     and Y [n_samples x q]. Fit p x q independent linear models. Prediction
     and stats return [p x q] array.
 
+    For large p x q, fit() can compute the correlations by tiles of X and Y
+    columns, bounding the memory by the tile size, and stream the tiles to a
+    callback, to an on-disk memmap, or keep only the strongest ones in a
+    sparse (COO) Corr_.
+
+    Parameters
+    ----------
+    dtype: numpy dtype
+        dtype of the computations and of Corr_ (default np.float64), use
+        np.float32 to halve memory and bandwidth.
+
+    method: "pearson" (default) or "spearman"
+        "spearman" correlates the ranks of the columns (ties get their
+        average rank), computed by blocks of columns. The ranks of the last
+        X are cached, so they are reused when the same X is correlated with
+        several Y.
 
     Example
     -------
@@ -28,23 +616,261 @@ class MUPairwiseCorr:
     >>> print f.shape
     (5, 3)
     """
-    def __init__(self, **kwargs):
-        pass
+    def __init__(self, dtype=np.float64, method="pearson", **kwargs):
+        if method not in ("pearson", "spearman"):
+            raise ValueError('method must be "pearson" or "spearman"')
+        self.dtype = dtype
+        self.method = method
+        self.Corr_ = None
+        self._ranked_X = None
+        self._X_ranks = None
+
+    def _ranks(self, X, max_elements=2 ** 27):
+        """Ranks of the columns of X, computed by blocks of columns (of
+        max_elements elements), cached for the last X."""
+        if X is self._ranked_X:
+            return self._X_ranks
+        ranks = np.empty(X.shape, dtype=self.dtype)
+        max_cols = max(1, int(max_elements / X.shape[0]))
+        for pp, X_block in iter_blocks(X, max_cols):
+            ranks[:, pp] = _rank_columns(np.asarray(X_block,
+                                                    dtype=np.float64))
+        self._ranked_X, self._X_ranks = X, ranks
+        return ranks
+
+    def fit(self, X, Y, max_elements=None, callback=None, out=None,
+            threshold=None, top_k=None):
+        """Compute the correlations Corr_ between the columns of X and Y.
+
+        If any of the following parameters is given, the correlations are
+        computed by (px, qy) tiles of columns of X and Y (arrays or
+        memmaps), standardized on the fly, such that the tiles and the
+        standardized columns fit in max_elements (default 2 ** 27).
+
+        Parameters
+        ----------
+        max_elements: int
+            tiles size bound, Corr_ is a dense (p, q) array.
+
+        callback: callable
+            called with (X columns slice, Y columns slice, tile) for each
+            tile. Corr_ is None unless out, threshold or top_k is given.
+
+        out: (p, q) array or memmap, or .npy filename
+            the tiles are written into out (a memmap is created for a
+            filename), which is Corr_.
+
+        threshold: float
+            keep only the correlations with |r| >= threshold. Corr_ is a
+            scipy.sparse.coo_matrix.
 
-    def fit(self, X, Y):
-        Xs = scale(X, copy=True)
-        Ys = scale(Y, copy=True)
+        top_k: int
+            keep only the top_k correlations (in |r|) of each column of X.
+            Corr_ is a scipy.sparse.coo_matrix.
+        """
         self.n_samples = X.shape[0]
-        self.Corr_ = np.dot(Xs.T, Ys) / self.n_samples
+        spearman = self.method == "spearman"
+        if spearman:
+            X = self._ranks(X)
+        if max_elements is None and callback is None and out is None and \
+                threshold is None and top_k is None:
+            if spearman:
+                Y = _rank_columns(np.asarray(Y, dtype=np.float64))
+            # standardized in float64 (see _column_stats())
+            Xs = _standardize(X, *_column_stats(X, X.shape[1]),
+                              dtype=self.dtype)
+            Ys = _standardize(Y, *_column_stats(Y, Y.shape[1]),
+                              dtype=self.dtype)
+            self.Corr_ = np.dot(Xs.T, Ys)
+            self.Corr_ /= self.n_samples
+            return self
+        if max_elements is None:
+            max_elements = 2 ** 27
+        n, p, q = X.shape[0], X.shape[1], Y.shape[1]
+        # (n, width) tiles of X and Y and their (width, width) correlations
+        width = max(1, int(np.sqrt(n ** 2 + max_elements) - n))
+        X_mean, X_std = _column_stats(X, width)
+        Y_mean, Y_std = _column_stats(Y, width, rank=spearman)
+        if isinstance(out, basestring):
+            out = np.lib.format.open_memmap(out, mode='w+', dtype=self.dtype,
+                                            shape=(p, q))
+        elif out is None and callback is None and threshold is None and \
+                top_k is None:
+            out = np.empty((p, q), dtype=self.dtype)
+        sparse = threshold is not None or top_k is not None
+        rows, cols, values = list(), list(), list()
+        for xx, X_block in iter_blocks(X, width):
+            Xs = _standardize(X_block, X_mean[xx], X_std[xx], self.dtype)
+            if top_k is not None:
+                best = np.zeros((Xs.shape[1], 0), dtype=self.dtype)
+                best_cols = np.zeros((Xs.shape[1], 0), dtype=int)
+            for yy, Y_block in iter_blocks(Y, width):
+                if spearman:
+                    Y_block = _rank_columns(np.asarray(Y_block,
+                                                       dtype=np.float64))
+                Ys = _standardize(Y_block, Y_mean[yy], Y_std[yy],
+                                  self.dtype)
+                corr = np.dot(Xs.T, Ys)
+                corr /= n
+                del Ys
+                if out is not None:
+                    out[xx, yy] = corr
+                if callback is not None:
+                    callback(xx, yy, corr)
+                if top_k is not None:
+                    best = np.hstack([best, corr])
+                    best_cols = np.hstack([best_cols, np.repeat(
+                        np.arange(yy.start, yy.start + corr.shape[1])[
+                            np.newaxis], corr.shape[0], axis=0)])
+                    if best.shape[1] > top_k:
+                        idx = np.argpartition(-np.abs(best), top_k - 1,
+                                              axis=1)[:, :top_k]
+                        best = np.take_along_axis(best, idx, axis=1)
+                        best_cols = np.take_along_axis(best_cols, idx, axis=1)
+                elif threshold is not None:
+                    i, j = np.nonzero(np.abs(corr) >= threshold)
+                    rows.append(i + xx.start)
+                    cols.append(j + yy.start)
+                    values.append(corr[i, j])
+                del corr
+            if top_k is not None:
+                rows.append(np.repeat(np.arange(xx.start, xx.start +
+                                                best.shape[0]),
+                                      best.shape[1]))
+                cols.append(best_cols.ravel())
+                values.append(best.ravel())
+        if sparse:
+            rows = np.concatenate(rows) if rows else np.zeros(0, dtype=int)
+            cols = np.concatenate(cols) if cols else np.zeros(0, dtype=int)
+            values = np.concatenate(values) if values else \
+                np.zeros(0, dtype=self.dtype)
+            if top_k is not None and threshold is not None:
+                kept = np.abs(values) >= threshold
+                rows, cols, values = rows[kept], cols[kept], values[kept]
+            self.Corr_ = coo_matrix((values, (rows, cols)), shape=(p, q))
+        else:
+            if isinstance(out, np.memmap):
+                out.flush()
+            self.Corr_ = out
         return self
 
+    def stats_maxT(self, X, Y, nperms=1000, two_tailed=True, perm_batch=10,
+                   n_jobs=1, random_state=None, max_elements=2 ** 27,
+                   permutations=None):
+        """p-values of the correlations Corr_ (fitted on X and Y) corrected
+        for the p x q comparisons by the maxT permutation procedure.
+
+        X and Y are standardized once (column statistics) and the rows of
+        the smaller of them are permuted. The max |r| of each permutation is
+        computed by tiles of columns (see fit()), each tile being tested
+        against batches of perm_batch permutations by a single matrix
+        product, so no (p, q) matrix of a permutation is ever formed. The
+        max over all the pairs of the permutations are stored in
+        max_corr_. With method="spearman" the ranks are permuted.
+
+        Parameters
+        ----------
+        nperms: int
+            number of permutations.
+
+        two_tailed: boolean
+            max of |r| (default) or of r.
+
+        perm_batch: int
+            number of permutations evaluated by a single matrix product.
+
+        n_jobs: int
+            number of processes the columns of the larger of X and Y are
+            split across (-1 for all the CPUs). It is shared with the
+            workers as a memmap.
+
+        random_state: None, int or RandomState
+            seeds the permutations, the results do not depend on n_jobs.
+
+        max_elements: int
+            bound on the size of the tiles and their temporaries.
+
+        permutations: PermutationSet
+            precomputed permutations of the rows, used instead of random
+            ones; nperms is then the size of the set.
+
+        Return
+        ------
+        pvals, of the shape of Corr_ (COO matrix for a sparse Corr_), or
+        None if Corr_ is None.
+
+        Example
+        -------
+        >>> import numpy as np
+        >>> from mulm import MUPairwiseCorr
+        >>> X = np.random.randn(50, 5)
+        >>> Y = np.random.randn(50, 300)
+        >>> corr = MUPairwiseCorr().fit(X, Y)
+        >>> pvals = corr.stats_maxT(X, Y, nperms=1000)
+        """
+        n = X.shape[0]
+        rank_Y = self.method == "spearman"
+        if rank_Y:
+            X = self._ranks(X)
+        # permute the rows of the smaller B, share the larger A
+        if X.shape[1] >= Y.shape[1]:
+            A, B, rank_A, rank_B = X, Y, False, rank_Y
+        else:
+            A, B, rank_A, rank_B = Y, X, rank_Y, False
+        b = perm_batch
+        # As, Bs and Bs_perms tiles and their correlations fit in
+        # max_elements: b w^2 + (2 + b) n w <= max_elements
+        a = (2 + b) * n
+        width = max(1, int((np.sqrt(a ** 2 + 4 * b * max_elements) - a) /
+                           (2 * b)))
+        A_stats = _column_stats(A, width, rank=rank_A)
+        B_stats = _column_stats(B, width, rank=rank_B)
+        nperms = _check_permutations(permutations, n, nperms)
+        shards = _permutation_shards(nperms, perm_batch, random_state,
+                                     permutations)
+        tasks = [(B, columns, shards, A_stats, B_stats, two_tailed, width,
+                  self.dtype, rank_A, rank_B)
+                 for columns in _split_blocks(A, width, n_jobs)]
+        self.max_corr_ = np.max(
+            map_shared(_corr_maxT_columns, A, tasks, n_jobs), axis=0)
+        if self.Corr_ is None:
+            return None
+        max_corr = np.sort(self.max_corr_)
+        corr = self.Corr_.tocoo() if issparse(self.Corr_) else self.Corr_
+        values = np.asarray(corr.data) if issparse(corr) else corr
+        if two_tailed:
+            values = np.abs(values)
+        pvals = (nperms - np.searchsorted(max_corr, values)) / float(nperms)
+        if issparse(corr):
+            return coo_matrix((pvals, (corr.row, corr.col)),
+                              shape=corr.shape)
+        return pvals
+
     def predict(self, X):
         pass
 
     def stats_f(self, pval=True):
-        R2 = self.Corr_ ** 2
+        """F statistics (and p-values) of the correlations, arrays of the
+        shape of Corr_, or COO matrices of the same pairs for a sparse
+        Corr_."""
+        if issparse(self.Corr_):
+            corr = self.Corr_.tocoo()
+            f_stats, p_vals = self._stats_f(np.asarray(corr.data), pval)
+            shape, ij = corr.shape, (corr.row, corr.col)
+            f_stats = coo_matrix((f_stats, ij), shape=shape)
+            if pval:
+                p_vals = coo_matrix((p_vals, ij), shape=shape)
+            return f_stats, p_vals
+        return self._stats_f(self.Corr_, pval)
+
+    def _stats_f(self, corr, pval):
         df_res = self.n_samples - 2
-        f_stats = R2 * df_res / (1 - R2)
+        # in place: f = R2 * df_res / (1 - R2)
+        f_stats = corr ** 2
+        denom = 1 - f_stats
+        f_stats /= denom
+        del denom
+        f_stats *= df_res
         if not pval:
             return (f_stats, None)
         else:
@@ -56,56 +882,93 @@ class MUOLS:
     Given two arrays X (n_samples, p) and Y (n_samples, q).
     Fit q independent linear models, ie., for all y in Y fit: lm(y ~ X)
 
+    Parameters
+    ----------
+    Y: (n_samples, q) array or memmap
+
+    X: (n_samples, p) array, the design.
+
+    dtype: numpy dtype
+        dtype of the computations (default np.float64). With np.float32 the
+        blocks of Y, the coefficients and the residuals are float32, sums of
+        squares are accumulated in float64.
+
     Example
     -------
     """
-    
-    def _block_slices(self, dim_size, block_size):
-        """Generator that yields slice objects for indexing into
-        sequential blocks of an array along a particular axis
-        """
-        count = 0
-        while True:
-            yield slice(count, count + block_size, 1)
-            count += block_size
-            if count >= dim_size:
-                raise StopIteration
-
-    def __init__(self, Y, X):
+
+    def __init__(self, Y, X, dtype=np.float64):
         self.coef = None
         if X.shape[0] != Y.shape[0]:
             raise ValueError('matrices are not aligned')
-        self.X = X  # TODO PERFORM BASIC CHECK ARRAY
+        self.dtype = np.dtype(dtype)
+        # TODO PERFORM BASIC CHECK ARRAY
+        self.X = np.asarray(X, dtype=self.dtype)
         self.Y = Y  # TODO PERFORM BASIC CHECK ARRAY
+        self.XtY = None
+        self.y_ss = None
+        self.pinv = None
+        self.pattern = None
 
-    def fit(self, block=False, max_elements=2 ** 27):
+    def fit(self, block=False, max_elements=2 ** 27, memory_budget=0.5):
         """Use block=True for huge matrices Y.
         Operations block by block to optimize time and memory.
         max_elements: block dimension (2**27 corresponds to 1Go)
+        Blocks of a memmaped Y are read by a background thread while the
+        previous block is processed (see mulm.utils.prefetch_blocks()).
+
+        block="auto" chooses the blocks from the memory available to the
+        process (see mulm.utils.available_memory()): all the temporaries of
+        a block (the block, its prefetch buffer, y_hat and the residuals) fit
+        in memory_budget, a fraction of the available memory, or a number of
+        bytes if > 1. max_elements is then ignored.
+        block="cache" chooses blocks that fit in the last level CPU cache,
+        for Y in memory.
+
+        Blocks of columns are contiguous reads of a Fortran-ordered Y, such
+        as the transpose of a (q, n) memmap, or the output of
+        mulm.utils.to_column_major(). A C-ordered memmap, for which they
+        would be strided reads, is streamed by chunks of rows of
+        max_elements elements instead, also prefetched: the fit is then
+        derived from the sufficient statistics X'Y and y_ss (see
+        fit_rows()), equal to the fit by blocks up to rounding errors.
         """
+        if block in ("auto", "cache"):
+            max_elements = self._auto_max_elements(block, memory_budget)
+        if block and self._row_major_memmap():
+            if block in ("auto", "cache"):
+                # a budget of max_elements elements of dtype
+                max_elements = max(1, max_elements * self.dtype.itemsize //
+                                   self._row_chunk_bytes())
+            elif max_elements < self.Y.shape[1]:
+                raise ValueError('the maximum number of elements is too small')
+            return self.fit_rows(max_elements=max_elements)
         self.block = block
         self.max_elements = max_elements
-        self.pinv = scipy.linalg.pinv(self.X)
+        self.pattern = None
+        if self.pinv is None:
+            self._fit_design()
         n, p = self.Y.shape
         q = self.X.shape[1]
-        if self.block:
+        if self.block in ("auto", "cache"):
+            max_cols = max(1, int(self.max_elements /
+                                  (n * self._block_temporaries())))
+        elif self.block:
             if self.max_elements < n:
                 raise ValueError('the maximum number of elements is too small')
             max_cols = int(self.max_elements / n)
         else:
             max_cols = p
-        self.coef = np.zeros((q, p))
+        self.coef = np.zeros((q, p), dtype=self.dtype)
         self.err_ss = np.zeros(p)
-        for pp in self._block_slices(p, max_cols):
-            if isinstance(self.Y, np.memmap):
-                Y_block = self.Y[:, pp].copy()  # copy to force a read
-            else: Y_block = self.Y[:, pp]
-            #Y_block = self.Y[:, pp]
+        self.XtY = self.y_ss = None
+        for pp, Y_block in iter_blocks(self.Y, max_cols):
+            Y_block = Y_block.astype(self.dtype, copy=False)
             self.coef[:, pp] = np.dot(self.pinv, Y_block)
             y_hat = np.dot(self.X, self.coef[:, pp])
             err = Y_block - y_hat
             del Y_block, y_hat
-            self.err_ss[pp] = np.sum(err ** 2, axis=0)
+            self.err_ss[pp] = np.sum(err ** 2, axis=0, dtype=np.float64)
             del err
 
 #        self.coef = np.dot(self.pinv, self.Y)
@@ -114,6 +977,288 @@ class MUOLS:
 #        self.err_ss = np.sum(err ** 2, axis=0)
         return self
 
+    def _block_temporaries(self):
+        """Number of (n_samples, block) arrays allocated while fitting a
+        block: y_hat, the residuals and their squares, the block itself when
+        it is a copy (memmap or other dtype) and the prefetch buffer of a
+        memmap (see iter_blocks()).
+        """
+        n_temporaries = 3
+        if isinstance(self.Y, np.memmap):
+            n_temporaries += 2
+        if self.Y.dtype != self.dtype:
+            n_temporaries += 1
+        return n_temporaries
+
+    def _row_chunk_bytes(self):
+        """Number of bytes per element of a chunk of rows streamed by
+        fit_rows(): its float64 copy and the two prefetch buffers of a
+        memmap (see iter_row_blocks()).
+        """
+        n_bytes = 8
+        if isinstance(self.Y, np.memmap):
+            n_bytes += 2 * self.Y.dtype.itemsize
+        return n_bytes
+
+    def _auto_max_elements(self, block, memory_budget):
+        """Number of elements (of dtype) of the memory budget of block="auto"
+        or of the last level CPU cache for block="cache"."""
+        if block == "cache":
+            budget = cache_size()
+            if budget is None:
+                budget = 2 ** 22
+        else:
+            budget = memory_budget
+            if memory_budget <= 1:
+                available = available_memory()
+                if available is None:
+                    raise ValueError('available memory is unknown, give '
+                                     'memory_budget in bytes')
+                budget = memory_budget * available
+        return max(1, int(budget / self.dtype.itemsize))
+
+    def _row_major_memmap(self):
+        """Whether Y is a memmap with strided columns (but one column)."""
+        return (isinstance(self.Y, np.memmap) and self.Y.shape[1] > 1 and
+                self.Y.shape[0] > 1 and not self.Y.flags.f_contiguous)
+
+    def fit_rows(self, max_elements=2 ** 27):
+        """Fit by streaming Y by chunks of rows, for Y with many rows
+        (samples) that do not fit in memory.
+        The chunks are accumulated into the sufficient statistics X'Y and
+        the sums of squares of the columns of Y, y_ss, from which are derived
+        coef = pinv(X'X) X'Y and err_ss = y_ss - sum(coef * X'Y). Memory
+        scales with the number of columns of Y times the number of
+        regressors. The statistics are accumulated in float64 whatever the
+        dtype, since err_ss is a difference of large terms when the mean of
+        Y is large. The chunks of a memmaped Y are read by a background
+        thread (see mulm.utils.iter_row_blocks()).
+
+        max_elements: number of elements of a chunk of rows of Y (2**27
+        corresponds to 1Go)
+        """
+        self.block = True
+        self.max_elements = max_elements
+        self.pattern = None
+        if self.pinv is None:
+            self._fit_design()
+        n, p = self.Y.shape
+        q = self.X.shape[1]
+        max_rows = max(1, int(self.max_elements / p))
+        self.XtY = np.zeros((q, p))
+        self.y_ss = np.zeros(p)
+        for rows, Y_chunk in iter_row_blocks(self.Y, max_rows):
+            Y_chunk = np.asarray(Y_chunk, dtype=np.float64)
+            self.XtY += np.dot(np.asarray(self.X[rows], dtype=np.float64).T,
+                               Y_chunk)
+            self.y_ss += np.einsum('ij,ij->j', Y_chunk, Y_chunk)
+            del Y_chunk
+        self._fit_sufficient_stats()
+        return self
+
+    def fit_missing(self, min_pattern_cols=10, max_elements=2 ** 27):
+        """Fit a Y with missing values (NaN), each column on the rows where
+        it is observed.
+
+        The columns of Y are grouped by missingness pattern and each pattern
+        is fitted at once, by blocks of max_elements elements. Patterns
+        shared by at least min_pattern_cols columns use the pseudo-inverse
+        of the observed rows of X. For rarer patterns, pinv(X'X) of the
+        observed rows is obtained by downdating X'X by the few missing rows,
+        which avoids the SVD of X.
+
+        The degrees of freedom self.df and the pattern self.pattern are then
+        given per column of Y, and t_test() returns (k, p) degrees of
+        freedom. The permutation procedures and t_test_scan() are not
+        available.
+
+        Example
+        -------
+        >>> import numpy as np
+        >>> import mulm
+        >>> X = np.random.randn(100, 5)
+        >>> Y = np.random.randn(100, 10)
+        >>> Y[3, :4] = np.nan
+        >>> mod = mulm.MUOLS(Y, X).fit_missing()
+        >>> tvals, pvals, df = mod.t_test(np.identity(5), pval=True)
+        """
+        self.block = True
+        self.max_elements = max_elements
+        self.XtY = self.y_ss = None
+        # df and rank are set per column: fit() must recompute the design
+        self.pinv = None
+        n, p = self.Y.shape
+        q = self.X.shape[1]
+        max_cols = max(1, int(self.max_elements / n))
+        # missingness pattern of each column
+        patterns = OrderedDict()
+        self.pattern = np.zeros(p, dtype=int)
+        for pp, Y_block in iter_blocks(self.Y, max_cols):
+            missing = np.packbits(np.isnan(Y_block), axis=0)
+            for j in xrange(missing.shape[1]):
+                key = missing[:, j].tostring()
+                self.pattern[pp.start + j] = patterns.setdefault(
+                    key, len(patterns))
+        del missing
+        n_patterns = len(patterns)
+        self.patterns_missing = np.zeros((n_patterns, n), dtype=bool)
+        for key, i in patterns.items():
+            self.patterns_missing[i] = np.unpackbits(
+                np.fromstring(key, dtype=np.uint8))[:n].astype(bool)
+        X = np.asarray(self.X, dtype=np.float64)
+        XtX = np.dot(X.T, X)
+        self.coef = np.zeros((q, p), dtype=self.dtype)
+        self.err_ss = np.zeros(p)
+        self.df = np.zeros(p)
+        self.rank = np.zeros(n_patterns, dtype=int)
+        self.patterns_cov_params = np.zeros((n_patterns, q, q))
+        for i in xrange(n_patterns):
+            kept = ~self.patterns_missing[i]
+            columns = np.where(self.pattern == i)[0]
+            X_kept = X[kept]
+            if len(columns) >= min_pattern_cols:
+                pinv = scipy.linalg.pinv(X_kept)
+                cov_params = np.dot(pinv, pinv.T)
+            else:
+                X_missing = X[~kept]
+                cov_params = scipy.linalg.pinvh(
+                    XtX - np.dot(X_missing.T, X_missing))
+                pinv = np.dot(cov_params, X_kept.T)
+            self.rank[i] = int(np.round(np.trace(np.dot(pinv, X_kept))))
+            self.patterns_cov_params[i] = cov_params
+            self.df[columns] = float(kept.sum() - self.rank[i])
+            pinv = pinv.astype(self.dtype)
+            X_kept = X_kept.astype(self.dtype)
+            for cc in block_slices(len(columns), max_cols):
+                cols = columns[cc]
+                Y_block = np.asarray(self.Y[:, cols][kept], dtype=self.dtype)
+                coef = np.dot(pinv, Y_block)
+                err = Y_block - np.dot(X_kept, coef)
+                self.coef[:, cols] = coef
+                self.err_ss[cols] = np.sum(err ** 2, axis=0,
+                                           dtype=np.float64)
+                del Y_block, coef, err
+        return self
+
+    def _check_complete(self):
+        if self.pattern is not None:
+            raise ValueError('not available on a model fitted by '
+                             'fit_missing()')
+
+    def partial_fit(self, Y, X):
+        """Update the fit with new rows (samples) of Y and X. The result is
+        the fit of the pooled rows. Only the new rows are read: the
+        sufficient statistics X'Y and y_ss (see fit_rows()) are updated and
+        coef and err_ss derived from them.
+
+        The pooled Y is not kept (self.Y is set to None), so the permutation
+        procedures are not available on the updated model.
+
+        Example
+        -------
+        >>> import numpy as np
+        >>> import mulm
+        >>> X = np.random.randn(100, 5)
+        >>> Y = np.random.randn(100, 10)
+        >>> mod = mulm.MUOLS(Y[:60], X[:60]).fit()
+        >>> mod = mod.partial_fit(Y[60:], X[60:])
+        >>> np.allclose(mod.coef, mulm.MUOLS(Y, X).fit().coef)
+        True
+        """
+        if X.shape[0] != Y.shape[0]:
+            raise ValueError('matrices are not aligned')
+        self._sufficient_stats()
+        if Y.shape[1] != self.XtY.shape[1] or X.shape[1] != self.X.shape[1]:
+            raise ValueError('matrices are not aligned')
+        Y = np.asarray(Y, dtype=np.float64)
+        self.XtY += np.dot(np.asarray(X, dtype=np.float64).T, Y)
+        self.y_ss += np.sum(Y ** 2, axis=0)
+        self._update_design(X)
+        return self
+
+    def merge(self, other):
+        """Merge the fit of another MUOLS, fitted on a disjoint set of rows
+        (samples) of the same variables. The result is the fit of the pooled
+        rows, computed from the sufficient statistics X'Y and y_ss of both
+        models (see fit_rows()).
+
+        The pooled Y is not kept (self.Y is set to None), so the permutation
+        procedures are not available on the merged model.
+        """
+        self._sufficient_stats()
+        other._sufficient_stats()
+        if other.XtY.shape != self.XtY.shape:
+            raise ValueError('matrices are not aligned')
+        self.XtY += other.XtY
+        self.y_ss += other.y_ss
+        self._update_design(other.X)
+        return self
+
+    def _sufficient_stats(self):
+        """Make sure X'Y and y_ss are available (models fitted by fit() only
+        hold coef and err_ss), fit the model if needed.
+        X'Y = X'X pinv Y = X'X coef and y'y = err_ss + y'X pinv Y.
+        """
+        self._check_complete()
+        if self.coef is None:
+            self.fit_rows()
+        elif self.XtY is None:
+            X = np.asarray(self.X, dtype=np.float64)
+            self.XtY = np.dot(np.dot(X.T, X), self.coef)
+            self.y_ss = self.err_ss + np.sum(self.coef * self.XtY, axis=0)
+
+    def _update_design(self, X):
+        """Append rows to X and refit from the sufficient statistics."""
+        self.X = np.vstack([self.X, X]).astype(self.dtype)
+        self.Y = None
+        # the pooled X is seldom refitted: not cached
+        self._set_design(_factorize(self.X, cache=False))
+        self._fit_sufficient_stats()
+
+    def _fit_sufficient_stats(self):
+        """coef and err_ss from the sufficient statistics X'Y and y_ss.
+        ||y - Hy||^2 = y'y - y'X pinv(X'X) X'y.
+        """
+        coef = np.dot(self.normalized_cov_params, self.XtY)
+        self.err_ss = self.y_ss - np.sum(coef * self.XtY, axis=0)
+        # clip rounding errors of perfect fits
+        np.maximum(self.err_ss, 0, out=self.err_ss)
+        self.coef = coef.astype(self.dtype, copy=False)
+
+    def _fit_design(self):
+        """Compute the pseudo-inverse of X and cache the design-only
+        quantities used by the tests: the rank of X, the degrees of freedom
+        of the residuals and normalized_cov_params = pinv pinv' = (X'X)^-1.
+        They are computed in float64 whatever the dtype, by a QR
+        factorization shared by the models with the same X (see
+        _factorize()).
+        """
+        self._set_design(_factorize(self.X))
+
+    def _get_design(self):
+        """The design-only quantities computed by _fit_design()."""
+        return dict(pinv=self.pinv, rank=self.rank, df=self.df,
+                    normalized_cov_params=self.normalized_cov_params)
+
+    def _set_design(self, design):
+        """Reuse the design-only quantities (see _get_design()) of a model
+        with the same X, fit() then skips _fit_design()."""
+        self.pinv = design['pinv'].astype(self.dtype, copy=False)
+        self.rank = design['rank']
+        self.df = design['df']
+        self.normalized_cov_params = design['normalized_cov_params']
+        return self
+
+    def _contrasts_var(self, contrasts):
+        """diag(C pinv pinv' C') for the (k, p) contrasts C. (k, q) array,
+        one column per column of Y, for a model fitted by fit_missing()."""
+        if self.pattern is not None:
+            cvar = np.sum(np.dot(contrasts, self.patterns_cov_params) *
+                          contrasts[:, np.newaxis, :], axis=2)
+            return cvar[:, self.pattern]
+        return np.sum(np.dot(contrasts, self.normalized_cov_params) *
+                      contrasts, axis=1)
+
     def predict(self, X):
         #from sklearn.utils import safe_asarray
         import numpy as np
@@ -138,7 +1283,8 @@ class MUOLS:
 
         Return
         ------
-        tstats (k, p) array, pvals (k, p) array, df (k,) array
+        tstats (k, p) array, pvals (k, p) array, df (k,) array ((k, p) for
+        a model fitted by fit_missing())
 
         Example
         -------
@@ -153,37 +1299,189 @@ class MUOLS:
         >>> tvals, pvals, df = mod.t_test(contrasts, pval=True, two_tailed=True)
         """
         contrasts = np.atleast_2d(np.asarray(contrasts))
-        n = self.X.shape[0]
-        t_stats_ = list()
-        p_vals_ = list()
-        df_ = list()
-        for contrast in contrasts:
-            #ccontrasts = np.asarray(contrasts)
-            # t = c'beta / std(c'beta)
-            # std(c'beta) = sqrt(var_err (c'X+)(X+'c))
-            #Xpinv = scipy.linalg.pinv(X)
-            cXpinv = np.dot(contrast, self.pinv)
-            R = np.eye(n) - np.dot(self.X, self.pinv)
-            df = np.trace(R)
-            ## Broadcast over ss errors
-            var_errors = self.err_ss / df
-            std_cbeta = np.sqrt(var_errors * np.dot(cXpinv, cXpinv.T))
-            t_stats = np.dot(contrast, self.coef) / std_cbeta
-            p_vals = None
-            if pval is not None:
+        # t = c'beta / std(c'beta)
+        # std(c'beta) = sqrt(var_err (c'X+)(X+'c))
+        ## Broadcast over ss errors
+        std_errors = np.sqrt(self.err_ss / self.df).astype(self.dtype)
+        t_stats = np.dot(contrasts.astype(self.dtype), self.coef)
+        t_stats /= std_errors
+        cvar = self._contrasts_var(contrasts)
+        if self.pattern is None:
+            cvar = cvar[:, np.newaxis]
+        t_stats /= np.sqrt(cvar)
+        p_vals = None
+        if pval is not None:
+            if two_tailed:
+                p_vals = stats.t.sf(np.abs(t_stats), self.df) * 2
+            else:
+                p_vals = stats.t.sf(t_stats, self.df)
+        if self.pattern is not None:
+            df = np.repeat(self.df[np.newaxis], contrasts.shape[0], axis=0)
+        else:
+            df = np.repeat(self.df, contrasts.shape[0])
+        return t_stats, p_vals, df
+
+    def t_test_scan(self, regressors, pval=False, two_tailed=True):
+        """Scan many regressors with X as shared covariates: for all x in
+        regressors and all y in Y, t-test x in lm(y ~ x + X). The model must
+        be fitted first.
+
+        With the covariates X projected out of the regressors,
+        rx = x - X pinv x, the effect of x is rx'y / rx'rx and the residual
+        sum of squares is err_ss - (rx'y)^2 / rx'rx, err_ss being the one of
+        lm(y ~ X). The regressors in the span of X are not estimable: their
+        effect, sd and t are NaN. All the pairs are obtained by products of the projected
+        regressors and the blocks of Y (see fit()), by blocks over both
+        axes.
+
+        Parameters
+        ----------
+        regressors: (n_samples, r) array
+
+        pval: boolean
+            compute pvalues (default is false)
+
+        two_tailed: boolean
+            one-tailed test or a two-tailed test (default True)
+
+        Return
+        ------
+        effect (r, q) array, sd (r, q) array, tstats (r, q) array,
+        pvals (r, q) array, df
+
+        Example
+        -------
+        >>> import numpy as np
+        >>> import mulm
+        >>> Z = np.hstack([np.random.randn(100, 3), np.ones((100, 1))])
+        >>> regressors = np.random.randn(100, 50)
+        >>> Y = np.random.randn(100, 10)
+        >>> mod = mulm.MUOLS(Y, Z).fit()
+        >>> effect, sd, tvals, pvals, df = mod.t_test_scan(regressors,
+        ...                                                pval=True)
+        """
+        self._check_Y()
+        self._check_complete()
+        regressors = np.asarray(regressors, dtype=self.dtype)
+        if regressors.ndim == 1:
+            regressors = regressors[:, np.newaxis]
+        if regressors.shape[0] != self.X.shape[0]:
+            raise ValueError('matrices are not aligned')
+        n, p = self.Y.shape[0], self.err_ss.shape[0]
+        r = regressors.shape[1]
+        df = self.df - 1
+        # projection of the covariates out of the regressors
+        regressors_res = regressors - np.dot(self.X,
+                                             np.dot(self.pinv, regressors))
+        regressors_ss = np.sum(regressors_res ** 2, axis=0, dtype=np.float64)
+        # regressors in the span of the covariates: only rounding errors are
+        # left in regressors_res
+        collinear = regressors_ss <= max(n, self.X.shape[1]) * \
+            np.finfo(self.dtype).eps * \
+            np.sum(regressors ** 2, axis=0, dtype=np.float64)
+        regressors_ss[collinear] = 1.
+        effect = np.zeros((r, p))
+        sd = np.zeros((r, p))
+        max_cols = max(1, min(p, int(self.max_elements / n)))
+        # (r_block, max_cols) outputs and temporaries
+        max_regressors = max(1, int(self.max_elements / (6 * max_cols)))
+        for pp, Y_block in iter_blocks(self.Y, max_cols):
+            Y_block = Y_block.astype(self.dtype, copy=False)
+            for rr in block_slices(r, max_regressors):
+                cross = np.dot(regressors_res[:, rr].T, Y_block)
+                ss = regressors_ss[rr][:, np.newaxis]
+                effect[rr, pp] = cross / ss
+                err_ss = self.err_ss[pp] - cross ** 2 / ss
+                sd[rr, pp] = np.sqrt(np.maximum(err_ss, 0) / df / ss)
+                del cross, err_ss
+        effect[collinear] = np.nan
+        sd[collinear] = np.nan
+        t_stats = effect / sd
+        p_vals = None
+        if pval:
+            with np.errstate(invalid='ignore'):  # NaN of collinear regressors
                 if two_tailed:
                     p_vals = stats.t.sf(np.abs(t_stats), df) * 2
                 else:
                     p_vals = stats.t.sf(t_stats, df)
-            t_stats_.append(t_stats)
-            p_vals_.append(p_vals)
-            df_.append(df)
-        return np.asarray(t_stats_), np.asarray(p_vals_), np.asarray(df_)
+        return effect, sd, t_stats, p_vals, df
 
-    def t_test_maxT(self, contrasts, nperms=1000, two_tailed=True, **kwargs):
+    def t_test_maxT(self, contrasts, nperms=1000, two_tailed=True,
+                    perm_batch=100, n_jobs=1, random_state=None,
+                    sign_flip=False, alpha=None, confidence=0.99,
+                    tail_approx=False, permutations=None, checkpoint=None,
+                    checkpoint_every=1000, perm_range=None, **kwargs):
         """Correct for multiple comparisons using maxT procedure. See t_test()
         For all parameters.
 
+        Y is read only once: the pseudo-inverses of the permuted designs
+        are computed by batches of perm_batch permutations, each block of Y
+        (see fit()) is then tested against all the permutations while it is
+        in memory and the running max |t| of each permutation is updated.
+
+        Parameters
+        ----------
+        perm_batch: int
+            number of permutations evaluated by a single matrix product
+            (default 100).
+
+        n_jobs: int
+            number of processes the permutations are split across
+            (default 1, -1 for all the CPUs). Y is shared with the workers
+            as a memmap, written once if it is not already a memmap.
+
+        random_state: None, int or RandomState
+            seeds the permutations. Each batch of perm_batch permutations
+            has its own seed, so the results do not depend on n_jobs.
+
+        sign_flip: boolean
+            randomly flip the signs of the rows (samples) instead of
+            permuting them, for one-sample or paired-difference designs
+            (eg. an intercept only X) whose rows are all equal, hence
+            invariant to permutations. The errors are then assumed
+            symmetric. Row i of Y multiplied by s_i on X is Y on the rows
+            of X multiplied by s_i, so a batch of sign flips is also tested
+            by a single matrix product.
+
+        alpha: float
+            sequential mode: the permutations are run by rounds ending
+            after 100, 200, 400... permutations (up to nperms) and stop
+            once, for all the tests, the Clopper-Pearson interval (at
+            level confidence) of the permutation p-value lies on one side
+            of alpha, ie. once the decisions at alpha are settled. The
+            p-values are estimated from the nperms_ permutations used.
+
+        confidence: float
+            level of the intervals of the sequential mode (default 0.99).
+
+        tail_approx: boolean
+            estimate the p-values with less than 10 exceedances from a
+            generalized Pareto distribution fitted to the upper tail of the
+            max-t null distribution, when it passes a goodness-of-fit test,
+            which resolves p-values far below 1 / nperms (see
+            _gpd_pvalues()). The fits (or None) of the contrasts are stored
+            in tail_fits_.
+
+        permutations: PermutationSet
+            precomputed permutations (or sign flips, then sign_flip is
+            ignored) of the rows, used instead of random ones; nperms is
+            then the size of the set.
+
+        checkpoint: string
+            .npz file where the max-t of the permutations done and the
+            permutation cursor are saved (atomically) every
+            checkpoint_every permutations (at least perm_batch per job). If
+            it exists, the run resumes from it. The permutations must be
+            reproducible: random_state given as an int, or permutations.
+            Y is then read once per checkpoint, rather than once.
+
+        perm_range: (start, stop)
+            only run the permutations start to stop (multiples of
+            perm_batch, or nperms) of the nperms, eg. on different nodes.
+            The checkpoints of the runs covering the nperms permutations
+            are reduced into the p-values of the whole run by merge_maxT().
+            The returned p-values are those of the range.
+
         Example
         -------
         >>> import numpy as np
@@ -202,30 +1500,128 @@ class MUOLS:
         >>> tvals, maxT, df = mod.t_test_maxT(contrasts, two_tailed=True)
         """
         #contrast = [0, 1] + [0] * (X.shape[1] - 2)
+        self._check_Y()
+        self._check_complete()
+        contrasts = np.atleast_2d(np.asarray(contrasts))
         tvals, _, df = self.t_test(contrasts=contrasts, pval=False, **kwargs)
-        max_t = list()
-        for i in xrange(nperms):
-            perm_idx = np.random.permutation(self.X.shape[0])
-            Xp = self.X[perm_idx, :]
-            muols = MUOLS(self.Y, Xp).fit(block=self.block,
-                                          max_elements=self.max_elements)
-            tvals_perm, _, _ = muols.t_test(contrasts=contrasts, pval=False,
-                                            two_tailed=two_tailed)
-            if two_tailed:
-                tvals_perm = np.abs(tvals_perm)
-            max_t.append(np.max(tvals_perm, axis=1))
-            del muols
-        max_t = np.array(max_t)
+        # design-only quantities are invariant to the permutation of the rows
+        cvar = self._contrasts_var(contrasts)
+        if permutations is not None:
+            sign_flip = permutations.sign_flip
+        nperms = _check_permutations(permutations, self.X.shape[0], nperms,
+                                     sign_flip)
+        if not sign_flip and np.all(self.X == self.X[:1]):
+            warnings.warn('the rows of X are all equal, hence invariant to '
+                          'permutations: use sign_flip=True')
+        if checkpoint is not None and permutations is None and \
+                not isinstance(random_state, (int, np.integer)):
+            raise ValueError('checkpoint needs reproducible permutations: '
+                             'random_state as an int, or permutations')
+        max_cols = self._perm_max_cols(perm_batch, contrasts.shape[0])
+        shards = _permutation_shards(nperms, perm_batch, random_state,
+                                     permutations)
+        if perm_range is None:
+            perm_range = (0, nperms)
+        elif alpha is not None:
+            raise ValueError('perm_range and alpha can not be combined')
+        range_start, range_stop = perm_range
+        if range_start % perm_batch or \
+                (range_stop % perm_batch and range_stop != nperms) or \
+                not 0 <= range_start < range_stop <= nperms:
+            raise ValueError('perm_range must be multiples of perm_batch '
+                             'within the nperms permutations')
+        state = _maxT_state(shards, nperms, perm_range, contrasts,
+                            two_tailed, sign_flip, tvals, df)
+        shards = [shard for shard in shards
+                  if shard[0] >= range_start and shard[1] <= range_stop]
+        rounds = [shards] if alpha is None else _sequential_rounds(shards)
         tvals_ = np.abs(tvals) if two_tailed else tvals
-        pvalues = np.array(
-            [np.array([np.sum(max_t[:, con] >= t) for t in tvals_[con, :]])\
-                / float(nperms) for con in xrange(contrasts.shape[0])])
+        max_t = np.zeros((0, contrasts.shape[0]))
+        cursor = range_start
+        if checkpoint is not None and os.path.exists(checkpoint):
+            max_t, cursor, _ = _load_checkpoint(checkpoint, state)
+        n_jobs = effective_n_jobs(n_jobs)
+        # at least a batch per job between checkpoints
+        checkpoint_every = max(checkpoint_every, perm_batch * n_jobs)
+        # Y shared once with the workers of all the rounds and checkpoints
+        Y, tmp_filename = self.Y, None
+        if n_jobs > 1:
+            handle, tmp_filename = share_array(self.Y)
+            Y = open_shared_array(handle)
+        try:
+            for shards in rounds:
+                chunks = [shards] if checkpoint is None else \
+                    _chunks(shards, checkpoint_every)
+                for chunk in chunks:
+                    chunk = [shard for shard in chunk if shard[0] >= cursor]
+                    if not chunk:  # done before the checkpoint
+                        continue
+                    tasks = [(self.X, self.pinv, shards_, contrasts, cvar,
+                              self.df, two_tailed, max_cols, sign_flip)
+                             for shards_ in _split(chunk, n_jobs)]
+                    max_t = np.vstack(
+                        [max_t] + map_shared(_maxT_shards, Y, tasks, n_jobs))
+                    cursor = chunk[-1][1]
+                    if checkpoint is not None:
+                        _save_checkpoint(checkpoint, state, max_t, cursor)
+                # permutations up to the end of the round
+                max_t_ = max_t[:shards[-1][1] - range_start]
+                counts = np.array(
+                    [max_t_.shape[0] -
+                     np.searchsorted(np.sort(max_t_[:, con]), tvals_[con, :])
+                     for con in xrange(contrasts.shape[0])])
+                if alpha is not None:
+                    lower, upper = _clopper_pearson(counts, max_t_.shape[0],
+                                                    confidence)
+                    if np.all((upper < alpha) | (lower > alpha)):
+                        break
+        finally:
+            del Y
+            if tmp_filename is not None:
+                os.remove(tmp_filename)
+        max_t = max_t_
+        self.nperms_ = max_t.shape[0]
+        pvalues = counts / float(self.nperms_)
+        if tail_approx:
+            self.tail_fits_ = list()
+            for con in xrange(contrasts.shape[0]):
+                pvalues[con], fit = _gpd_pvalues(max_t[:, con], tvals_[con])
+                self.tail_fits_.append(fit)
         return tvals, pvalues, df
 
-    def t_test_minP(self, contrasts, nperms=10000, two_tailed=True, **kwargs):
+    def _check_Y(self):
+        if self.Y is None:
+            raise ValueError('Y is not available on a model updated by '
+                             'partial_fit() or merge()')
+
+    def _perm_max_cols(self, perm_batch, n_contrasts):
+        """Number of columns of Y blocks streamed by the permutation
+        procedures, such that the block and the temporaries of a batch of
+        permutations (coefficients, X'Y and t-values) fit in max_elements.
+        """
+        n = self.X.shape[0]
+        q = self.X.shape[1]
+        max_cols = int(self.max_elements /
+                       (n + perm_batch * (2 * q + n_contrasts)))
+        return max(1, min(max_cols, self.Y.shape[1]))
+
+    def t_test_minP(self, contrasts, nperms=10000, two_tailed=True,
+                    perm_batch=100, n_jobs=1, random_state=None,
+                    permutations=None, **kwargs):
         """Correct for multiple comparisons using minP procedure.
         For all parameters.
 
+        The same permutations (seeded by random_state, see t_test_maxT())
+        are applied to all the columns of Y. The columns are processed by
+        blocks: the t-statistics of all the permutations of a block are
+        computed at once and ranked by sorting, the running min p-value of
+        each permutation being updated in place. With n_jobs > 1 the blocks
+        of Y are split across the processes and the min p-values of the
+        permutations are merged.
+
+        permutations: a PermutationSet of nperms + 1 permutations of the
+        rows can be given instead of random ones.
+
         Example
         -------
         >>> import numpy as np
@@ -242,69 +1638,91 @@ class MUOLS:
         >>> contrasts = np.identity(X.shape[1])
         >>> tvals, maxT, df = mod.t_test_minP(contrasts, two_tailed=True)
         """
+        self._check_Y()
+        self._check_complete()
+        contrasts = np.atleast_2d(np.asarray(contrasts))
         tvals, pvals, df = self.t_test(contrasts=contrasts, pval=True, **kwargs)
-        min_p = np.ones((contrasts.shape[0], nperms))
-        perm_idx = np.zeros((self.X.shape[0], nperms + 1), dtype='int')
-        for i in xrange(self.Y.shape[1]):
-            Y_curr = self.Y[:, i]
-            Yp_curr = np.zeros((self.X.shape[0], nperms + 1))
-
-            for j in xrange(nperms + 1):
-                if i == 0:
-                    perm_idx[:, j] = np.random.permutation(self.X.shape[0])
-                Yp_curr[:, j] = Y_curr[perm_idx[:, j]]
-            muols = MUOLS(Yp_curr, self.X).fit()
-            tvals_perm, _, _ = muols.t_test(contrasts=contrasts, pval=False,
-                                            two_tailed=two_tailed)
-            if two_tailed:
-                tvals_perm = np.abs(tvals_perm)
-            pval_perm = np.array(
-               [np.array([((np.sum(tvals_perm[con, :] >= tvals_perm[con, k])) - 1) \
-                         for k in xrange(nperms)]) / float(nperms) \
-                             for con in xrange(contrasts.shape[0])])
-            min_p = np.array(
-               [(np.min(np.vstack((min_p[con, :], pval_perm[con, :])), axis=0)) \
-                         for con in xrange(contrasts.shape[0])])
+        cvar = self._contrasts_var(contrasts)
+        nperms = _check_permutations(permutations, self.X.shape[0],
+                                     nperms + 1) - 1
+        max_cols = self._minP_max_cols(nperms, perm_batch, contrasts.shape[0])
+        shards = _permutation_shards(nperms + 1, perm_batch, random_state,
+                                     permutations)
+        tasks = [(self.X, self.pinv, shards, columns, contrasts, cvar, self.df,
+                  two_tailed, max_cols)
+                 for columns in _split_blocks(self.Y, max_cols, n_jobs)]
+        min_p = np.min(map_shared(_minP_columns, self.Y, tasks, n_jobs),
+                       axis=0)
         pvalues = np.array(
-               [np.array([np.sum(min_p[con, :] <= p) \
-                         for p in pvals[con, :]]) / float(nperms) \
-                             for con in xrange(contrasts.shape[0])])
+            [np.searchsorted(np.sort(min_p[con, :]), pvals[con, :],
+                             side='right') / float(nperms)
+                for con in xrange(contrasts.shape[0])])
         return tvals, pvalues, df
 
+    def _minP_max_cols(self, nperms, perm_batch, n_contrasts):
+        """Number of columns of Y blocks processed by minP, such that the
+        t-statistics of all the permutations of a block, their ranks and the
+        temporaries of a batch of permutations fit in max_elements.
+        """
+        n = self.X.shape[0]
+        q = self.X.shape[1]
+        max_cols = int(self.max_elements /
+                       (n + 3 * (nperms + 1) * n_contrasts +
+                        perm_batch * (2 * q + n_contrasts)))
+        return max(1, min(max_cols, self.Y.shape[1]))
+
     def f_test(self, contrast, pval=False):
-        from sklearn.utils import array2d
-        #Ypred = self.predict(self.X)
-        #betas = self.coef
-        #ss_errors = np.sum((self.Y - self.y_hat) ** 2, axis=0)
-        C1 = array2d(contrast).T
+        """F-test the contrast, a (c, p) matrix, ie. the full model X against
+        the reduced model X0 = X C0, C0 being the orthogonal complement of
+        the contrast, for all the columns of Y.
+
+        A batch of contrasts can be tested at once by giving a list of (c, p)
+        matrices.
+
+        The extra sum of squares y'(H - H0)y, H and H0 being the projections
+        on X and X0, is computed from the coefficients b as b' A b with the
+        (p, p) matrix A = X'X - X'H0X, by blocks of columns of coef. The
+        (n, n) projections are never formed.
+
+        Return
+        ------
+        fstats (q,) array, pvals (q,) array (or None)
+        ((k, q) arrays for a batch of k contrasts)
+        """
+        self._check_complete()
+        batch = isinstance(contrast, (list, tuple)) and len(contrast) > 0 \
+            and all(np.ndim(c) == 2 for c in contrast)
+        contrasts = contrast if batch else [contrast]
         n, p = self.X.shape
-        #Xpinv = scipy.linalg.pinv(X)
-        rank_x = np.linalg.matrix_rank(self.pinv)
-        C0 = np.eye(p) - np.dot(C1, scipy.linalg.pinv(C1))  # Ortho. cont. to C1
-        X0 = np.dot(self.X, C0)  # Design matrix of the reduced model
-        X0pinv = scipy.linalg.pinv(X0)
-        rank_x0 = np.linalg.matrix_rank(X0pinv)
-        # Find the subspace (X1) of Xc1, which is orthogonal to X0
-        # The projection matrix M due to X1 can be derived from the residual
-        # forming matrix of the reduced model X0
-        # R0 is the residual forming matrix of the reduced model
-        R0 = np.eye(n) - np.dot(X0, X0pinv)
-        # R is the residual forming matrix of the full model
-        R = np.eye(n) - np.dot(self.X, self.pinv)
-        # compute the projection matrix
-        M = R0 - R
-        #Ypred = np.dot(self.X, betas)
-        y_hat = self.predict(self.X)
-        SS = np.sum(y_hat * np.dot(M, y_hat), axis=0)
-        df_c1 = rank_x - rank_x0
-        df_res = n - rank_x
-        ## Broadcast over self.err_ss of Y
-        f_stats = (SS * df_res) / (self.err_ss * df_c1)
-        if not pval:
-            return (f_stats, None)
-        else:
-            p_vals = stats.f.sf(f_stats, df_c1, df_res)
-            return f_stats, p_vals
+        q = self.coef.shape[1]
+        X = np.asarray(self.X, dtype=np.float64)
+        XtX = np.dot(X.T, X)
+        max_cols = max(1, int(getattr(self, 'max_elements', 2 ** 27) / p))
+        f_stats = np.zeros((len(contrasts), q))
+        df_c1 = np.zeros(len(contrasts))
+        for i, c in enumerate(contrasts):
+            C1 = np.atleast_2d(np.asarray(c, dtype=np.float64)).T
+            # Ortho. cont. to C1 and design matrix of the reduced model
+            C0 = np.eye(p) - np.dot(C1, scipy.linalg.pinv(C1))
+            X0 = np.dot(X, C0)
+            design0 = _factorize(X0)
+            # X'H0X = X'X0 pinv(X0) X
+            A = XtX - np.dot(np.dot(X.T, X0), np.dot(design0['pinv'], X))
+            A = (A + A.T) / 2
+            df_c1[i] = self.rank - design0['rank']
+            for pp in block_slices(q, max_cols):
+                coef = np.asarray(self.coef[:, pp], dtype=np.float64)
+                SS = np.sum(coef * np.dot(A, coef), axis=0)
+                ## Broadcast over self.err_ss of Y
+                f_stats[i, pp] = (SS * self.df) / (self.err_ss[pp] * df_c1[i])
+                del coef, SS
+        p_vals = None
+        if pval:
+            p_vals = stats.f.sf(f_stats, df_c1[:, np.newaxis], self.df)
+        if not batch:
+            f_stats = f_stats[0]
+            p_vals = p_vals[0] if pval else None
+        return f_stats, p_vals
 
     def stats_f_coefficients(self, X, Y, contrast, pval=False):
         return self.stats_f(contrast, pval=pval)
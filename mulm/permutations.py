@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed sets of permutations (or sign flips) of the rows, shared by the
+permutation procedures.
+"""
+import json
+import hashlib
+import numpy as np
+from sklearn.utils import check_random_state
+
+
+def _index_dtype(n):
+    """Smallest unsigned integer dtype of the indices of n rows."""
+    return np.uint16 if n <= 2 ** 16 else np.uint32
+
+
+class PermutationSet:
+    """nperms permutations (or sign flips) of n rows (samples), generated up
+    front and stored compactly: uint16 (uint32 for n > 65536) indices, or
+    bit-packed sign flips. A set can be saved and memory-mapped back from
+    disk, which shares the same permutations across contrasts, datasets,
+    runs and worker processes (a memory-mapped set is pickled by filename).
+
+    Parameters
+    ----------
+    n: int
+        number of rows.
+
+    nperms: int
+        number of permutations.
+
+    random_state: None, int or RandomState
+
+    blocks: (n,) array
+        labels of exchangeability blocks (eg. site or family). Rows are only
+        permuted within their block, and with sign_flip all the rows of a
+        block share the same sign.
+
+    sign_flip: boolean
+        random +/-1 sign flips instead of permutations.
+
+    Example
+    -------
+    >>> import numpy as np
+    >>> import mulm
+    >>> X = np.ones((40, 1))
+    >>> Y = np.random.randn(40, 100)
+    >>> perms = mulm.PermutationSet(40, 1000, random_state=0, sign_flip=True)
+    >>> perms.save("perms.npy")
+    >>> perms = mulm.PermutationSet.load("perms.npy")
+    >>> mod = mulm.MUOLS(Y, X).fit()
+    >>> tvals, pvals, df = mod.t_test_maxT([1], permutations=perms)
+    """
+
+    def __init__(self, n, nperms, random_state=None, blocks=None,
+                 sign_flip=False):
+        self.n = n
+        self.nperms = nperms
+        self.sign_flip = sign_flip
+        self.blocks = None
+        if blocks is not None:
+            if len(blocks) != n:
+                raise ValueError('blocks must have n labels')
+            self.blocks = np.unique(np.asarray(blocks),
+                                    return_inverse=True)[1]
+        self.filename = None
+        self.data = self._generate(check_random_state(random_state))
+
+    def _generate(self, random_state, chunk=1000):
+        if self.sign_flip:
+            # one sign per block (per row without blocks)
+            codes = np.arange(self.n) if self.blocks is None else self.blocks
+            data = np.zeros((self.nperms, (self.n + 7) // 8), dtype=np.uint8)
+            for start in xrange(0, self.nperms, chunk):
+                stop = min(start + chunk, self.nperms)
+                bits = random_state.randint(
+                    2, size=(stop - start, codes.max() + 1)).astype(bool)
+                data[start:stop] = np.packbits(bits[:, codes], axis=1)
+            return data
+        dtype = _index_dtype(self.n)
+        codes = np.zeros(self.n) if self.blocks is None else self.blocks
+        # rows grouped by block
+        grouped = np.argsort(codes, kind='mergesort')
+        data = np.zeros((self.nperms, self.n), dtype=dtype)
+        for start in xrange(0, self.nperms, chunk):
+            stop = min(start + chunk, self.nperms)
+            # rows grouped by block, in a random order within each block,
+            # are assigned to the grouped positions of the block
+            order = np.argsort(codes + random_state.rand(stop - start, self.n),
+                               axis=1)
+            data[start:stop][:, grouped] = order
+        return data
+
+    def __len__(self):
+        return self.nperms
+
+    def batch(self, start, stop):
+        """(stop - start, n) array of the permutation indices (of the stored
+        uint16 or uint32 dtype, valid indices) or of the +/-1 signs (int8) of
+        the permutations start to stop."""
+        data = np.array(self.data[start:stop])
+        if self.sign_flip:
+            bits = np.unpackbits(data, axis=1)[:, :self.n]
+            return bits.astype(np.int8) * 2 - 1
+        return data
+
+    def __getitem__(self, i):
+        return self.batch(i, i + 1)[0]
+
+    def digest(self):
+        """SHA-1 (hex) of the permutations and of n, nperms, blocks and
+        sign_flip, which identifies the set (eg. in checkpoints)."""
+        sha1 = hashlib.sha1(json.dumps(
+            [self.n, self.nperms, self.sign_flip,
+             None if self.blocks is None else self.blocks.tolist()]))
+        for start in xrange(0, self.nperms, 1000):
+            sha1.update(np.ascontiguousarray(
+                self.data[start:start + 1000]).view(np.uint8))
+        return sha1.hexdigest()
+
+    def save(self, filename):
+        """Save into the .npy file filename and the JSON sidecar
+        filename + ".json"."""
+        with open(filename, 'wb') as fd:
+            np.save(fd, np.asarray(self.data))
+        meta = dict(n=self.n, nperms=self.nperms, sign_flip=self.sign_flip,
+                    blocks=None if self.blocks is None else
+                    self.blocks.tolist())
+        with open(filename + ".json", 'w') as fd:
+            json.dump(meta, fd)
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """Load a set saved by save(), memory-mapped by default."""
+        with open(filename + ".json") as fd:
+            meta = json.load(fd)
+        perms = cls(meta["n"], 0, blocks=meta["blocks"],
+                    sign_flip=meta["sign_flip"])
+        perms.nperms = meta["nperms"]
+        perms.data = np.load(filename, mmap_mode=mmap_mode)
+        if mmap_mode is not None:
+            perms.filename = filename
+        return perms
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.filename is not None:
+            del state["data"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.filename is not None:
+            self.data = np.load(self.filename, mmap_mode='r')
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the MULM DataFrame interface.
+"""
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+from numpy.testing import assert_almost_equal
+from mulm.dataframe.mulm_dataframe import MULM
+from mulm.permutations import PermutationSet
+
+
+def make_dataset(n=100, px=4, pz=2, py=6, seed=1):
+    regressors = ["x_%i" % i for i in xrange(px)]
+    z_colnames = ["z_%i" % i for i in xrange(pz)]
+    targets = ["y_%i" % i for i in xrange(py)]
+    np.random.seed(seed)
+    X = np.random.randn(n, px)
+    Z = np.random.randn(n, pz)
+    Y = np.random.randn(n, py)
+    Y[:, :2] += np.dot(X, np.ones((px, 1))) + 1.
+    data = pd.DataFrame(np.concatenate([Y, X, Z], 1),
+                        columns=targets + regressors + z_colnames)
+    return data, targets, regressors, z_colnames
+
+
+class TestMULMDataFrame(unittest.TestCase):
+
+    def test_ttest_grouped(self):
+        data, targets, regressors, z_colnames = make_dataset()
+        # missing targets and covariates
+        data.loc[3, "y_1"] = np.nan
+        data.loc[[5, 8], "y_2"] = np.nan
+        data.loc[10, "z_1"] = np.nan
+        covar_model = "+".join(z_colnames)
+        formulas = ['%s~%s+%s' % (target, regressor, covar_model)
+                    for target in targets for regressor in regressors]
+        # not batchable: transformed target
+        formulas += ['np.exp(y_0 / 10.)~x_0+%s' % covar_model]
+        model = MULM(data=data, formulas=formulas)
+        fd, out_filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for contrasts in [1, None]:
+                stats = model.t_test(contrasts=contrasts)
+                # out_filemane fits all the formulas with statsmodels
+                stats_sm = model.t_test(contrasts=contrasts,
+                                        out_filemane=out_filename)
+                assert np.all(stats.columns == stats_sm.columns)
+                assert stats.shape == stats_sm.shape
+                for col in ["formula", "target", "contrast"]:
+                    assert np.all(stats[col] == stats_sm[col])
+                for col in ["effect", "sd", "tvalue", "pvalue", "df"]:
+                    assert_almost_equal(stats[col].values,
+                                        stats_sm[col].values)
+        finally:
+            os.remove(out_filename)
+
+
+    def test_cache(self):
+        data, targets, regressors, z_colnames = make_dataset()
+        data.loc[3, "y_1"] = np.nan
+        covar_model = "+".join(z_colnames)
+        formulas = ['%s~%s+%s' % (target, regressor, covar_model)
+                    for target in targets for regressor in regressors]
+        # 4 right-hand sides, 8 (right-hand side, kept rows) groups
+        model = MULM(data=data, formulas=formulas)
+        stats = model.t_test(contrasts=1)
+        info = model.cache_info()
+        assert info["designs"]["misses"] == 4
+        assert info["designs"]["hits"] == 0
+        assert info["factorizations"]["misses"] == 8
+        stats_cached = model.t_test(contrasts=None)
+        stats_cached = model.t_test(contrasts=1)
+        info = model.cache_info()
+        assert info["designs"]["misses"] == 4
+        assert info["designs"]["hits"] == 8
+        assert info["factorizations"]["misses"] == 8
+        assert info["factorizations"]["hits"] == 16
+        for col in ["effect", "sd", "tvalue", "pvalue", "df"]:
+            assert_almost_equal(stats_cached[col].values, stats[col].values)
+        # LRU eviction
+        model = MULM(data=data, formulas=formulas, cache_size=2)
+        model.t_test(contrasts=1)
+        model.t_test(contrasts=1)
+        info = model.cache_info()
+        assert info["designs"]["currsize"] == 2
+        assert info["designs"]["hits"] == 0
+        # new data
+        model.data = data.copy()
+        model.t_test(contrasts=1)
+        assert model.cache_info()["designs"]["misses"] == 12
+
+    def test_maxT(self):
+        data, targets, regressors, z_colnames = make_dataset(n=50)
+        covar_model = "+".join(z_colnames)
+        formulas = ['%s~%s+%s' % (target, regressor, covar_model)
+                    for target in targets for regressor in regressors]
+        # not batchable: transformed target
+        formulas += ['np.exp(y_0 / 10.)~x_0+%s' % covar_model]
+        nperm = 10
+        model = MULM(data=data, formulas=formulas)
+        stats = model.t_test_maxT(contrasts=1, nperm=nperm, perm_batch=4,
+                                  random_state=3)
+        for col in ["pvalues_onesided_maxT", "pvalues_twosided_maxT",
+                    "pvalue_fdr_bh"]:
+            assert col in stats.columns
+        assert np.all(stats.pvalues_onesided_maxT <=
+                      stats.pvalues_twosided_maxT)
+        # permute the rows of all the targets and refit all the formulas
+        random_state = np.random.RandomState(3)
+        keys = np.vstack([random_state.rand(4, data.shape[0]),
+                          random_state.rand(4, data.shape[0]),
+                          random_state.rand(2, data.shape[0])])
+        tmax, tmin = list(), list()
+        for perm in xrange(nperm):
+            data_perm = data.copy()
+            order = np.argsort(keys[perm])
+            data_perm[targets] = data[targets].values[order]
+            stats_perm = MULM(data=data_perm, formulas=formulas).t_test(
+                contrasts=1)
+            tmax.append(np.max(stats_perm.tvalue))
+            tmin.append(np.min(stats_perm.tvalue))
+        assert_almost_equal(model.tmax, tmax)
+        assert_almost_equal(model.tmin, tmin)
+        tmax_2sided = np.maximum(np.abs(tmax), np.abs(tmin))
+        pvalues_twosided = [np.sum(tmax_2sided >= np.abs(t)) / float(nperm)
+                            for t in stats.tvalue]
+        assert_almost_equal(stats.pvalues_twosided_maxT, pvalues_twosided)
+
+
+    def test_duplicated_index(self):
+        data, targets, regressors, z_colnames = make_dataset(n=40)
+        data.loc[3, "y_1"] = np.nan
+        data.loc[10, "z_1"] = np.nan
+        formulas = ['%s~%s+%s' % (target, regressor, "+".join(z_colnames))
+                    for target in targets for regressor in regressors]
+        formulas += ['np.exp(y_0 / 10.)~x_0+z_0']
+        stats = MULM(data=data, formulas=formulas).t_test_maxT(
+            contrasts=1, nperm=10, random_state=0)
+        data_dup = data.copy()
+        data_dup.index = np.arange(data.shape[0]) // 2
+        stats_dup = MULM(data=data_dup, formulas=formulas).t_test_maxT(
+            contrasts=1, nperm=10, random_state=0)
+        for col in ["tvalue", "df", "pvalues_twosided_maxT"]:
+            assert_almost_equal(stats_dup[col].values, stats[col].values)
+
+    def test_maxT_permutation_set(self):
+        data, targets, regressors, z_colnames = make_dataset(n=40)
+        formulas = ['%s~%s+%s' % (target, regressor, "+".join(z_colnames))
+                    for target in targets for regressor in regressors]
+        perms = PermutationSet(data.shape[0], 8, random_state=0)
+        model = MULM(data=data, formulas=formulas)
+        model.t_test_maxT(contrasts=1, perm_batch=3, permutations=perms)
+        tmax = list()
+        for perm in perms.batch(0, 8):
+            data_perm = data.copy()
+            data_perm[targets] = data[targets].values[perm]
+            tmax.append(np.max(MULM(data=data_perm, formulas=formulas).t_test(
+                contrasts=1).tvalue))
+        assert_almost_equal(model.tmax, tmax)
+
+    def test_maxT_permutation_set_blocks(self):
+        data, targets, regressors, z_colnames = make_dataset(n=40, px=2,
+                                                             py=3)
+        # missing targets and covariates: rows dropped by some formulas
+        data.loc[[3, 4, 21], "y_1"] = np.nan
+        data.loc[[10, 30], "z_1"] = np.nan
+        formulas = ['%s~%s+%s' % (target, regressor, "+".join(z_colnames))
+                    for target in targets for regressor in regressors]
+        blocks = np.arange(data.shape[0]) % 3
+        perms = PermutationSet(data.shape[0], 6, random_state=0,
+                               blocks=blocks)
+        model = MULM(data=data, formulas=formulas)
+        model.t_test_maxT(contrasts=1, perm_batch=4, permutations=perms)
+        tmax = np.empty(6)
+        tmax.fill(-np.inf)
+        for formula in formulas:
+            target = formula.split("~")[0]
+            kept = np.where(data[[target] + z_colnames].notnull().all(
+                axis=1).values)[0]
+            for i, perm in enumerate(perms.batch(0, 6)):
+                # the kept rows of each block, in the order of the
+                # permutation, go to the kept rows of the block
+                order = kept.copy()
+                for block in np.unique(blocks):
+                    in_block = blocks[kept] == block
+                    in_perm = [r for r in perm if r in set(kept[in_block])]
+                    order[in_block] = in_perm
+                assert np.all(blocks[order] == blocks[kept])
+                data_perm = data.iloc[kept].copy()
+                data_perm[target] = data[target].values[order]
+                tmax[i] = max(tmax[i], np.max(MULM(
+                    data=data_perm, formulas=[formula]).t_test(
+                    contrasts=1).tvalue))
+        assert_almost_equal(model.tmax, tmax)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
@@ -4,11 +4,17 @@ Created on Sun Jun 16 09:13:14 2013
 
 @author: edouard
 """
+import os
+import mmap
+import shutil
+import tempfile
 import unittest
+import warnings
 
 import numpy as np
 from numpy.testing import assert_almost_equal
 import mulm
+import mulm.utils
 import statsmodels.api as sm
 
 
@@ -64,6 +70,434 @@ class TestMULMOLS(unittest.TestCase):
 #        mulm_pvals -  np.min(sm_pvals*2,1)
 
 
+    def test_fit_rows(self):
+        n, px, py = 80, 4, 30
+        np.random.seed(6)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py) + 10
+        Y[:, :3] += np.dot(X, np.random.randn(px, 3))
+        contrasts = np.identity(px)
+        mod = mulm.MUOLS(Y, X).fit()
+        mod_rows = mulm.MUOLS(Y, X).fit_rows(max_elements=7 * py)
+        assert_almost_equal(mod_rows.coef, mod.coef)
+        assert_almost_equal(mod_rows.err_ss, mod.err_ss)
+        tvals, pvals, df = mod.t_test(contrasts, pval=True)
+        tvals_rows, pvals_rows, df_rows = mod_rows.t_test(contrasts, pval=True)
+        assert_almost_equal(tvals_rows, tvals)
+        assert_almost_equal(pvals_rows, pvals)
+        assert np.all(df_rows == df)
+
+    def test_partial_fit_merge(self):
+        n, px, py = 90, 3, 20
+        np.random.seed(7)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, :3] += np.dot(X, np.random.randn(px, 3))
+        contrasts = np.identity(px)
+        mod = mulm.MUOLS(Y, X).fit()
+        tvals, pvals, df = mod.t_test(contrasts, pval=True)
+        # incremental
+        mod_inc = mulm.MUOLS(Y[:40], X[:40]).fit()
+        mod_inc.partial_fit(Y[40:70], X[40:70]).partial_fit(Y[70:], X[70:])
+        # row shards fitted independently
+        mod_merge = mulm.MUOLS(Y[:50], X[:50]).fit_rows().merge(
+            mulm.MUOLS(Y[50:], X[50:]).fit())
+        for mod_ in [mod_inc, mod_merge]:
+            assert_almost_equal(mod_.coef, mod.coef)
+            assert_almost_equal(mod_.err_ss, mod.err_ss)
+            tvals_, pvals_, df_ = mod_.t_test(contrasts, pval=True)
+            assert_almost_equal(tvals_, tvals)
+            assert_almost_equal(pvals_, pvals)
+            assert np.all(df_ == df)
+
+    def test_fit_memmap(self):
+        n, px, py = 50, 3, 40
+        np.random.seed(8)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        fd, filename = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        try:
+            np.save(filename, Y)
+            Y_memmap = np.load(filename, mmap_mode='r')
+            mod = mulm.MUOLS(Y, X).fit(block=True, max_elements=n * 7)
+            mod_memmap = mulm.MUOLS(Y_memmap, X).fit(block=True,
+                                                     max_elements=n * 7)
+            assert_almost_equal(mod_memmap.coef, mod.coef)
+            assert_almost_equal(mod_memmap.err_ss, mod.err_ss)
+            blocks = [(pp, Y_block.copy()) for pp, Y_block in
+                      mulm.utils.iter_blocks(Y_memmap, 7)]
+            assert len(blocks) == 6
+            for pp, Y_block in blocks:
+                assert np.all(Y_block == Y[:, pp])
+            # chunks of rows of the C-ordered memmap, prefetched
+            chunks = [(rows, Y_chunk.copy()) for rows, Y_chunk in
+                      mulm.utils.iter_row_blocks(Y_memmap, 15)]
+            assert len(chunks) == 4
+            for rows, Y_chunk in chunks:
+                assert np.all(Y_chunk == Y[rows])
+            self.assertRaises(ValueError, mulm.MUOLS(Y_memmap, X).fit,
+                              block=True, max_elements=py - 1)
+            del Y_memmap
+        finally:
+            os.remove(filename)
+
+    def test_column_major(self):
+        n, px, py = 64, 3, 300
+        np.random.seed(9)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            np.save(os.path.join(tmpdir, "Y.npy"), Y)
+            Y_memmap = np.load(os.path.join(tmpdir, "Y.npy"), mmap_mode='r')
+            Y_cols = mulm.utils.to_column_major(
+                Y_memmap, os.path.join(tmpdir, "Y_cols.npy"), max_elements=1000)
+            assert Y_cols.flags.f_contiguous
+            assert np.all(Y_cols == Y)
+            # blocks of 64 columns of 8 bytes * 64 rows are aligned on pages
+            blocks = mulm.utils.column_blocks(Y_cols, 100)
+            assert sum(pp.stop - pp.start for pp in blocks) == py
+            col_bytes = n * Y.dtype.itemsize
+            for pp in blocks[1:]:
+                assert (Y_cols.ctypes.data + pp.start * col_bytes) % \
+                    mmap.PAGESIZE == 0
+            mod = mulm.MUOLS(Y, X).fit()
+            mod_cols = mulm.MUOLS(Y_cols, X).fit(block=True,
+                                                 max_elements=n * 100)
+            assert_almost_equal(mod_cols.coef, mod.coef)
+            assert_almost_equal(mod_cols.err_ss, mod.err_ss)
+            # the transpose of a (q, n) memmap is shared without a copy
+            np.save(os.path.join(tmpdir, "Yt.npy"),
+                    np.ascontiguousarray(Y.T))
+            Y_t = np.load(os.path.join(tmpdir, "Yt.npy"), mmap_mode='r').T
+            handle, tmp_filename = mulm.utils.share_array(Y_t)
+            assert tmp_filename is None and handle[-1] == 'F'
+            assert np.all(mulm.utils.open_shared_array(handle) == Y)
+            del Y_memmap, Y_cols, mod_cols, Y_t
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_float32(self):
+        n, px, py = 100, 4, 50
+        np.random.seed(10)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = (np.random.randn(n, py) + 100).astype(np.float32)
+        Y[:, :5] += np.dot(X, np.random.randn(px, 5))
+        contrasts = np.identity(px)
+        mod64 = mulm.MUOLS(Y, X).fit()
+        tvals64, pvals64, df64 = mod64.t_test(contrasts, pval=True)
+        # float32 t-values agree with float64 ones within 1e-3
+        for fit in [dict(), dict(block=True, max_elements=n * 7)]:
+            mod32 = mulm.MUOLS(Y, X, dtype=np.float32).fit(**fit)
+            assert mod32.coef.dtype == np.float32
+            tvals32, pvals32, df32 = mod32.t_test(contrasts, pval=True)
+            assert np.allclose(tvals32, tvals64, rtol=1e-3, atol=1e-3)
+            assert np.allclose(pvals32, pvals64, atol=1e-3)
+            assert np.all(df32 == df64)
+        mod32 = mulm.MUOLS(Y, X, dtype=np.float32).fit_rows(max_elements=500)
+        assert np.allclose(mod32.t_test(contrasts)[0], tvals64,
+                           rtol=1e-3, atol=1e-3)
+        _, maxT64, _ = mod64.t_test_maxT(contrasts, nperms=100,
+                                         random_state=0)
+        _, maxT32, _ = mod32.t_test_maxT(contrasts, nperms=100,
+                                         random_state=0)
+        assert np.allclose(maxT32, maxT64, atol=0.02)
+        corr64 = mulm.MUPairwiseCorr().fit(X[:, :3], Y - 100)
+        corr32 = mulm.MUPairwiseCorr(dtype=np.float32).fit(X[:, :3], Y - 100)
+        assert corr32.Corr_.dtype == np.float32
+        assert np.allclose(corr32.Corr_, corr64.Corr_, atol=1e-5)
+        # standardized in float64: no loss (nor warnings) for a large mean
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            corr32 = mulm.MUPairwiseCorr(dtype=np.float32).fit(X[:, :3], Y)
+        assert not caught
+        assert np.allclose(corr32.Corr_, corr64.Corr_, atol=1e-5)
+
+    def test_float32_rows_memmap(self):
+        # large mean: err_ss = y_ss - sum(coef * X'Y) cancels
+        n, px, py = 200, 3, 50
+        np.random.seed(11)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = (np.random.randn(n, py) + 1000).astype(np.float32)
+        Y[:, :5] += X[:, :1] * .3
+        contrasts = np.identity(px)[:2]
+        tvals64 = mulm.MUOLS(Y.astype(np.float64), X).fit().t_test(
+            contrasts)[0]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "Y.npy")
+            np.save(filename, Y)  # C-ordered
+            Ym = np.load(filename, mmap_mode='r')
+            mods = [mulm.MUOLS(Ym, X, dtype=np.float32).fit(
+                        block=True, max_elements=n * 10),
+                    mulm.MUOLS(Ym, X, dtype=np.float32).fit_rows(
+                        max_elements=n * 10),
+                    mulm.MUOLS(Ym[:100], X[:100], dtype=np.float32).fit(
+                        ).partial_fit(Y[100:], X[100:])]
+            for mod in mods:
+                assert np.allclose(mod.t_test(contrasts)[0], tvals64,
+                                   rtol=1e-3, atol=1e-3)
+            # the float64 chunks and the prefetch buffers fit in the budget
+            mod = mulm.MUOLS(Ym, X, dtype=np.float32).fit(
+                block="auto", memory_budget=n * 16 * 10)
+            assert mod.max_elements == n * 10
+            assert np.allclose(mod.t_test(contrasts)[0], tvals64,
+                               rtol=1e-3, atol=1e-3)
+            del Ym, mods, mod
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_fit_auto_block(self):
+        n, px, py = 50, 3, 40
+        np.random.seed(11)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        mod = mulm.MUOLS(Y, X).fit()
+        # memory budget in bytes: 3 temporaries of 50 x 8 columns
+        mod_auto = mulm.MUOLS(Y, X).fit(block="auto",
+                                        memory_budget=3 * n * 8 * 8)
+        assert mod_auto.max_elements == 3 * n * 8
+        assert_almost_equal(mod_auto.coef, mod.coef)
+        assert_almost_equal(mod_auto.err_ss, mod.err_ss)
+        for block in ["auto", "cache"]:
+            mod_auto = mulm.MUOLS(Y, X).fit(block=block)
+            assert_almost_equal(mod_auto.coef, mod.coef)
+            assert_almost_equal(mod_auto.err_ss, mod.err_ss)
+
+    def test_ftest(self):
+        n, px, py = 50, 5, 8
+        np.random.seed(17)
+        X = np.hstack([np.random.randn(n, px - 1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, :2] += np.dot(X[:, :2], [[1, .5], [-.5, 1]])
+        contrasts = [np.identity(px)[:2], np.identity(px)[[2]],
+                     np.identity(px)[:4]]
+        mod = mulm.MUOLS(Y, X).fit(block=True, max_elements=n * 3)
+        fvals, pvals = mod.f_test(contrasts, pval=True)
+        assert fvals.shape == pvals.shape == (len(contrasts), py)
+        for i, contrast in enumerate(contrasts):
+            fvals_i, pvals_i = mod.f_test(contrast, pval=True)
+            assert_almost_equal(fvals_i, fvals[i])
+            for j in xrange(py):
+                sm_ftest = sm.OLS(Y[:, j], X).fit().f_test(contrast)
+                assert_almost_equal(fvals[i, j], np.squeeze(sm_ftest.fvalue))
+                assert_almost_equal(pvals[i, j], np.squeeze(sm_ftest.pvalue))
+
+    def test_design_factorization(self):
+        n, px, py = 40, 4, 6
+        np.random.seed(16)
+        X = np.random.randn(n, px)
+        Y = np.random.randn(n, py)
+        mod = mulm.MUOLS(Y, X).fit()
+        assert mod.rank == px and mod.df == n - px
+        assert_almost_equal(mod.pinv, np.linalg.pinv(X))
+        assert_almost_equal(mod.normalized_cov_params,
+                            np.linalg.inv(np.dot(X.T, X)))
+        # the factorization is shared by the models with the same design
+        mod2 = mulm.MUOLS(Y[:, :2], X.copy()).fit()
+        assert mod2.pinv is mod.pinv
+        # rank deficient design
+        X_def = np.hstack([X, X[:, :1] + X[:, 1:2]])
+        mod_def = mulm.MUOLS(Y, X_def).fit()
+        assert mod_def.rank == px and mod_def.df == n - px
+        assert_almost_equal(mod_def.pinv, np.linalg.pinv(X_def))
+        assert_almost_equal(np.dot(X_def, mod_def.coef),
+                            np.dot(X, mod.coef))
+        assert_almost_equal(mod_def.err_ss, mod.err_ss)
+        # the pooled designs of partial_fit() are not cached
+        cache = mulm.models._designs_cache
+        currsize = cache.info()["currsize"]
+        mulm.MUOLS(Y[:20], X[:20]).fit().partial_fit(Y[20:], X[20:])
+        assert cache.info()["currsize"] == currsize + 1
+        mulm.clear_designs_cache()
+        assert cache.info()["currsize"] == cache.info()["currbytes"] == 0
+        # bounded in bytes
+        cache = mulm.utils.LRUCache(maxsize=10, maxbytes=100,
+                                    sizeof=lambda value: value.nbytes)
+        for i in xrange(4):
+            cache.put(i, np.zeros(5))  # 40 bytes
+        cache.put(4, np.zeros(20))  # larger than maxbytes
+        assert 0 not in cache and 1 not in cache and 4 not in cache
+        assert cache.info()["currbytes"] == 80
+
+    def test_fit_missing(self):
+        n, px, py = 50, 4, 30
+        np.random.seed(15)
+        X = np.hstack([np.random.randn(n, px - 1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, :3] += np.dot(X, np.random.randn(px, 3))
+        # a frequent pattern (10 columns), rare ones, complete columns
+        Y[[2, 7], :10] = np.nan
+        Y[5, 12] = Y[9, 13] = Y[[1, 4, 6], 14] = np.nan
+        contrasts = np.identity(px)
+        for min_pattern_cols in [1, 10, py + 1]:
+            mod = mulm.MUOLS(Y, X).fit_missing(
+                min_pattern_cols=min_pattern_cols, max_elements=n * 4)
+            tvals, pvals, df = mod.t_test(contrasts, pval=True)
+            assert df.shape == (px, py)
+            for j in xrange(py):
+                kept = ~np.isnan(Y[:, j])
+                mod_j = mulm.MUOLS(Y[kept, j:j + 1], X[kept]).fit()
+                tvals_j, pvals_j, df_j = mod_j.t_test(contrasts, pval=True)
+                assert_almost_equal(mod.coef[:, j], mod_j.coef[:, 0])
+                assert_almost_equal(tvals[:, j], tvals_j[:, 0])
+                assert_almost_equal(pvals[:, j], pvals_j[:, 0])
+                assert np.all(df[:, j] == df_j)
+        self.assertRaises(ValueError, mod.t_test_maxT, contrasts, nperms=10)
+        # fit() after fit_missing() recomputes the design
+        Y = np.random.randn(n, py)
+        mod = mulm.MUOLS(Y, X).fit()
+        tvals, pvals, df = mod.t_test(contrasts, pval=True)
+        mod.fit_missing().fit()
+        tvals_refit, pvals_refit, df_refit = mod.t_test(contrasts, pval=True)
+        assert df_refit.shape == (px,) and np.all(df_refit == df)
+        assert_almost_equal(tvals_refit, tvals)
+
+    def test_pairwise_corr_tiles(self):
+        n, px, py = 30, 23, 17
+        np.random.seed(18)
+        X = np.random.randn(n, px)
+        Y = np.random.randn(n, py) + np.dot(X[:, :3], np.ones((3, py)))
+        corr = mulm.MUPairwiseCorr().fit(X, Y).Corr_
+        max_elements = n * 10  # tiles of 4 columns
+        assert_almost_equal(mulm.MUPairwiseCorr().fit(
+            X, Y, max_elements=max_elements).Corr_, corr)
+        # callback
+        tiles = np.zeros((px, py))
+        def callback(xx, yy, tile):
+            tiles[xx, yy] += tile
+        mod = mulm.MUPairwiseCorr().fit(X, Y, max_elements=max_elements,
+                                        callback=callback)
+        assert mod.Corr_ is None
+        assert_almost_equal(tiles, corr)
+        # memmap
+        tmpdir = tempfile.mkdtemp()
+        try:
+            np.save(os.path.join(tmpdir, "X.npy"), X)
+            filename = os.path.join(tmpdir, "corr.npy")
+            mod = mulm.MUPairwiseCorr().fit(
+                np.load(os.path.join(tmpdir, "X.npy"), mmap_mode='r'), Y,
+                max_elements=max_elements, out=filename)
+            assert isinstance(mod.Corr_, np.memmap)
+            assert_almost_equal(np.load(filename), corr)
+            del mod
+        finally:
+            shutil.rmtree(tmpdir)
+        # threshold
+        mod = mulm.MUPairwiseCorr().fit(X, Y, max_elements=max_elements,
+                                        threshold=.5)
+        dense = mod.Corr_.toarray()
+        assert_almost_equal(dense, np.where(np.abs(corr) >= .5, corr, 0))
+        f_sparse, p_sparse = mod.stats_f()
+        f_dense, p_dense = mulm.MUPairwiseCorr().fit(X, Y).stats_f()
+        kept = np.abs(corr) >= .5
+        assert_almost_equal(f_sparse.toarray()[kept], f_dense[kept])
+        assert_almost_equal(p_sparse.toarray()[kept], p_dense[kept])
+        # top-k
+        mod = mulm.MUPairwiseCorr().fit(X, Y, max_elements=max_elements,
+                                        top_k=3)
+        dense = mod.Corr_.toarray()
+        assert mod.Corr_.nnz == px * 3
+        top = np.sort(np.abs(corr), axis=1)[:, -3:]
+        assert_almost_equal(np.sort(np.abs(dense), axis=1)[:, -3:], top)
+
+    def test_pairwise_corr_maxT(self):
+        n, px, py = 30, 5, 40
+        np.random.seed(19)
+        X = np.random.randn(n, px)
+        Y = np.random.randn(n, py)
+        Y[:, :2] += X[:, :2]
+        nperms, perm_batch = 20, 6
+        # tiles of 2 columns
+        max_elements = perm_batch * 4 + (2 + perm_batch) * n * 2
+        corr = mulm.MUPairwiseCorr().fit(X, Y)
+        pvals = corr.stats_maxT(X, Y, nperms=nperms, perm_batch=perm_batch,
+                                random_state=5, max_elements=max_elements)
+        # brute force: the rows of X (the smaller) are permuted
+        shards = mulm.models._permutation_shards(nperms, perm_batch, 5)
+        perms = np.vstack([mulm.models._shard_permutations(n, shard)
+                           for shard in shards])
+        max_corr = [np.max(np.abs(mulm.MUPairwiseCorr().fit(
+            X[perm], Y).Corr_)) for perm in perms]
+        assert_almost_equal(corr.max_corr_, max_corr)
+        pvals_ = [[np.sum(max_corr >= np.abs(r)) / float(nperms) for r in row]
+                  for row in corr.Corr_]
+        assert_almost_equal(pvals, pvals_)
+        # workers
+        corr_jobs = mulm.MUPairwiseCorr().fit(X, Y)
+        corr_jobs.stats_maxT(X, Y, nperms=nperms, perm_batch=perm_batch,
+                             random_state=5, max_elements=max_elements,
+                             n_jobs=2)
+        assert np.all(corr_jobs.max_corr_ == corr.max_corr_)
+        # not fitted: only max_corr_
+        corr_null = mulm.MUPairwiseCorr()
+        assert corr_null.stats_maxT(X, Y, nperms=nperms, perm_batch=perm_batch,
+                                    random_state=5) is None
+        assert_almost_equal(corr_null.max_corr_, corr.max_corr_)
+        # sparse Corr_
+        corr_sparse = mulm.MUPairwiseCorr().fit(X, Y, threshold=.3)
+        pvals_sparse = corr_sparse.stats_maxT(X, Y, nperms=nperms,
+                                              perm_batch=perm_batch,
+                                              random_state=5)
+        kept = np.abs(corr.Corr_) >= .3
+        assert_almost_equal(pvals_sparse.toarray()[kept], pvals[kept])
+
+    def test_pairwise_corr_spearman(self):
+        from scipy.stats import spearmanr
+        n, px, py = 30, 4, 9
+        np.random.seed(20)
+        X = np.round(np.random.randn(n, px), 1)  # ties
+        Y = np.round(np.random.randn(n, py) + X[:, :1] ** 3, 1)
+        corr_sp = spearmanr(X, Y)[0][:px, px:]
+        corr = mulm.MUPairwiseCorr(method="spearman")
+        assert_almost_equal(corr.fit(X, Y).Corr_, corr_sp)
+        X_ranks = corr._X_ranks
+        assert_almost_equal(corr.fit(X, Y, max_elements=n * 8).Corr_,
+                            corr_sp)
+        # the ranks of X are reused
+        assert corr._X_ranks is X_ranks
+        corr.fit(X, Y[:, :3])
+        assert corr._X_ranks is X_ranks
+        assert_almost_equal(corr.Corr_, corr_sp[:, :3])
+        # permutations of the ranks
+        pvals = corr.fit(X, Y).stats_maxT(X, Y, nperms=10, random_state=2,
+                                          perm_batch=4)
+        corr_ranks = mulm.MUPairwiseCorr().fit(
+            mulm.models._rank_columns(X), mulm.models._rank_columns(Y))
+        pvals_ranks = corr_ranks.stats_maxT(
+            mulm.models._rank_columns(X), mulm.models._rank_columns(Y),
+            nperms=10, random_state=2, perm_batch=4)
+        assert_almost_equal(corr.max_corr_, corr_ranks.max_corr_)
+        assert_almost_equal(pvals, pvals_ranks)
+
+    def test_scan(self):
+        n, pz, px, py = 60, 3, 8, 5
+        np.random.seed(12)
+        Z = np.hstack([np.random.randn(n, pz), np.ones((n, 1))])
+        X = np.random.randn(n, px)
+        Y = np.random.randn(n, py)
+        Y[:, :2] += np.dot(X[:, :2], [[1, .5], [.5, 1]]) + Z[:, :1]
+        mod = mulm.MUOLS(Y, Z).fit(block=True, max_elements=n * 2)
+        effect, sd, tvals, pvals, df = mod.t_test_scan(X, pval=True)
+        assert tvals.shape == (px, py)
+        # one full OLS per regressor: y ~ x_j + Z
+        for j in xrange(px):
+            mod_j = mulm.MUOLS(Y, np.hstack([X[:, [j]], Z])).fit()
+            contrast = [1] + [0] * Z.shape[1]
+            tvals_j, pvals_j, df_j = mod_j.t_test(contrast, pval=True)
+            assert_almost_equal(tvals[j], tvals_j[0])
+            assert_almost_equal(pvals[j], pvals_j[0])
+            assert_almost_equal(effect[j], mod_j.coef[0])
+            assert df == df_j[0]
+        # regressors in the span of the covariates are not estimable
+        for dtype in [np.float64, np.float32]:
+            mod = mulm.MUOLS(Y, Z, dtype=dtype).fit()
+            effect, sd, tvals, pvals, df = mod.t_test_scan(
+                np.hstack([Z[:, :1], Z[:, :2] * 2 - 1, X[:, :1]]), pval=True)
+            assert np.all(np.isnan(tvals[:3])) and np.all(np.isnan(sd[:3]))
+            assert np.all(np.isfinite(tvals[3]))
+
     def test_maxT(self):
         n = 100
         px = 5
@@ -104,6 +538,209 @@ class TestMULMOLS(unittest.TestCase):
         assert np.sum(maxT < 0.05) < (expected_tp + 2) and np.sum(maxT < 0.05) > (expected_tp - 2)
         assert np.sum(maxT_block < 0.05) < (expected_tp + 2) and np.sum(maxT_block < 0.05) > (expected_tp - 2)
 
+    def test_maxT_batched_permutations(self):
+        n, px, py = 50, 4, 30
+        np.random.seed(1)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        contrasts = np.identity(px)
+        mod = mulm.MUOLS(Y, X).fit(block=True, max_elements=1000)
+        tvals, maxT, df = mod.t_test_maxT(contrasts, nperms=50,
+                                          two_tailed=True, perm_batch=7,
+                                          random_state=2)
+        # Brute force: refit each permuted design with the same permutations
+        perms = np.vstack([mulm.models._shard_permutations(n, shard)
+            for shard in mulm.models._permutation_shards(50, 7, 2)])
+        max_t = list()
+        for perm in perms:
+            Xp = X[perm, :]
+            tvals_perm, _, _ = mulm.MUOLS(Y, Xp).fit().t_test(contrasts)
+            max_t.append(np.max(np.abs(tvals_perm), axis=1))
+        max_t = np.array(max_t)
+        maxT_brute = np.array(
+            [[np.sum(max_t[:, con] >= np.abs(t)) / 50. for t in tvals[con, :]]
+                for con in xrange(px)])
+        assert_almost_equal(maxT, maxT_brute)
+
+    def test_maxT_sign_flip(self):
+        n, py = 40, 25
+        np.random.seed(21)
+        Y = np.random.randn(n, py)
+        Y[:, :3] += 1.
+        for X in [np.ones((n, 1)),
+                  np.hstack([np.ones((n, 1)), np.random.randn(n, 1)])]:
+            contrasts = np.identity(X.shape[1])[:1]
+            mod = mulm.MUOLS(Y, X).fit(block=True, max_elements=n * 4)
+            tvals, maxT, df = mod.t_test_maxT(contrasts, nperms=30,
+                                              perm_batch=7, random_state=3,
+                                              sign_flip=True)
+            # Brute force: refit each sign-flipped Y
+            signs = np.vstack([mulm.models._shard_signs(n, shard)
+                for shard in mulm.models._permutation_shards(30, 7, 3)])
+            max_t = list()
+            for s in signs:
+                tvals_flip, _, _ = mulm.MUOLS(s[:, np.newaxis] * Y, X).fit(
+                    ).t_test(contrasts)
+                max_t.append(np.max(np.abs(tvals_flip)))
+            maxT_brute = [np.sum(np.array(max_t) >= np.abs(t)) / 30.
+                          for t in tvals[0]]
+            assert_almost_equal(maxT[0], maxT_brute)
+            assert np.all(maxT[0, :3] < .1)
+
+    def test_maxT_early_stopping(self):
+        n, px, py = 40, 2, 20
+        np.random.seed(22)
+        X = np.hstack([np.random.randn(n, px - 1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, :3] += 2 * X[:, :1]
+        contrasts = [1, 0]
+        mod = mulm.MUOLS(Y, X).fit()
+        tvals, pvals, df = mod.t_test_maxT(contrasts, nperms=6400,
+                                           random_state=4, alpha=.05)
+        assert 100 <= mod.nperms_ < 6400
+        # same as the first nperms_ permutations
+        tvals_, pvals_, df_ = mod.t_test_maxT(contrasts, nperms=mod.nperms_,
+                                              random_state=4)
+        assert_almost_equal(pvals, pvals_)
+        assert np.all(pvals[0, :3] < .05)
+        assert np.all(pvals[0, 3:] > .05)
+        # alpha = None runs all the permutations
+        mod.t_test_maxT(contrasts, nperms=300, random_state=4)
+        assert mod.nperms_ == 300
+
+    def test_maxT_tail_approx(self):
+        n, py = 30, 20
+        np.random.seed(23)
+        X = np.hstack([np.random.randn(n, 1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, :4] += np.array([.8, 1., 1.2, 1.4]) * X[:, :1]
+        contrasts = [1, 0]
+        mod = mulm.MUOLS(Y, X).fit()
+        # brute force
+        tvals, pvals, df = mod.t_test_maxT(contrasts, nperms=20000,
+                                           perm_batch=1000, random_state=1)
+        tvals, pvals_tail, df = mod.t_test_maxT(contrasts, nperms=1000,
+                                                random_state=2,
+                                                tail_approx=True)
+        assert mod.tail_fits_[0] is not None
+        # calibration of a p-value < 10 / 1000 (.0009 by brute force)
+        assert pvals[0, 0] < .002
+        assert pvals[0, 0] / 2 < pvals_tail[0, 0] < pvals[0, 0] * 2
+        # p-values that are 0 by brute force are resolved
+        assert np.all(pvals_tail[0, 2:4] > 0)
+        assert np.all(pvals_tail[0, 2:4] < pvals_tail[0, 0])
+        # the common p-values are the empirical ones
+        tvals, pvals_emp, df = mod.t_test_maxT(contrasts, nperms=1000,
+                                               random_state=2)
+        common = pvals_emp[0] * 1000 >= 10
+        assert np.all(pvals_tail[0, common] == pvals_emp[0, common])
+        # fallback: a discrete null does not pass the goodness-of-fit test
+        null = np.random.RandomState(0).poisson(2, size=1000)
+        p, fit = mulm.models._gpd_pvalues(null, [5, 7, 20])
+        assert fit is None
+        assert_almost_equal(p, [np.mean(null >= v) for v in [5, 7, 20]])
+
+    def test_maxT_checkpoint(self):
+        n, px, py = 30, 3, 12
+        np.random.seed(25)
+        X = np.hstack([np.random.randn(n, px - 1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, :2] += X[:, :1]
+        contrasts = np.identity(px)[:2]
+        mod = mulm.MUOLS(Y, X).fit()
+        tvals, pvals, df = mod.t_test_maxT(contrasts, nperms=100,
+                                           perm_batch=10, random_state=6)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(tmpdir, "maxT.npz")
+            tvals_, pvals_ckpt, df_ = mod.t_test_maxT(
+                contrasts, nperms=100, perm_batch=10, random_state=6,
+                checkpoint=checkpoint, checkpoint_every=30)
+            assert np.all(pvals_ckpt == pvals)
+            # pre-empted after 40 permutations: resume
+            max_t, cursor, state = mulm.models._load_checkpoint(checkpoint)
+            assert cursor == 100 and max_t.shape == (100, 2)
+            mulm.models._save_checkpoint(checkpoint, state, max_t[:40], 40)
+            tvals_, pvals_resumed, df_ = mod.t_test_maxT(
+                contrasts, nperms=100, perm_batch=10, random_state=6,
+                checkpoint=checkpoint, n_jobs=2)
+            assert np.all(pvals_resumed == pvals)
+            # a checkpoint of another run
+            self.assertRaises(ValueError, mod.t_test_maxT, contrasts,
+                              nperms=100, perm_batch=10, random_state=7,
+                              checkpoint=checkpoint)
+            # not reproducible permutations
+            self.assertRaises(ValueError, mod.t_test_maxT, contrasts,
+                              nperms=100, perm_batch=10,
+                              checkpoint=os.path.join(tmpdir, "none.npz"))
+            assert not os.path.exists(os.path.join(tmpdir, "none.npz"))
+            # Y shared once across the checkpoints
+            tvals_, pvals_jobs, df_ = mod.t_test_maxT(
+                contrasts, nperms=100, perm_batch=10, random_state=6,
+                checkpoint=os.path.join(tmpdir, "jobs.npz"),
+                checkpoint_every=10, n_jobs=2)
+            assert np.all(pvals_jobs == pvals)
+            # shards of permutation ranges merged
+            filenames = list()
+            for start, stop in [(50, 100), (0, 20), (20, 50)]:
+                filenames.append(os.path.join(tmpdir, "maxT_%i.npz" % start))
+                mod.t_test_maxT(contrasts, nperms=100, perm_batch=10,
+                                random_state=6, perm_range=(start, stop),
+                                checkpoint=filenames[-1])
+            tvals_, pvals_merged, df_ = mulm.merge_maxT(filenames)
+            assert np.all(tvals_ == tvals)
+            assert np.all(pvals_merged == pvals)
+            assert np.all(df_ == df)
+            self.assertRaises(ValueError, mulm.merge_maxT, filenames[:2])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_permutations_n_jobs(self):
+        n, px, py = 30, 3, 20
+        np.random.seed(3)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        contrasts = np.identity(px)
+        mod = mulm.MUOLS(Y, X).fit(block=True, max_elements=200)
+        _, maxT_1, _ = mod.t_test_maxT(contrasts, nperms=40, perm_batch=6,
+                                       random_state=5, n_jobs=1)
+        _, maxT_3, _ = mod.t_test_maxT(contrasts, nperms=40, perm_batch=6,
+                                       random_state=5, n_jobs=3)
+        assert np.all(maxT_1 == maxT_3)
+        _, minP_1, _ = mod.t_test_minP(contrasts, nperms=40, perm_batch=6,
+                                       random_state=5, n_jobs=1)
+        _, minP_2, _ = mod.t_test_minP(contrasts, nperms=40, perm_batch=6,
+                                       random_state=5, n_jobs=2)
+        assert np.all(minP_1 == minP_2)
+
+    def test_minP_vectorized(self):
+        n, px, py, nperms = 30, 3, 12, 60
+        np.random.seed(4)
+        X = np.hstack([np.random.randn(n, px-1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, 0] += X[:, 0]
+        contrasts = np.identity(px)
+        mod = mulm.MUOLS(Y, X).fit(block=True, max_elements=50000)
+        tvals, minP, df = mod.t_test_minP(contrasts, nperms=nperms,
+                                          perm_batch=8, random_state=0)
+        _, pvals, _ = mod.t_test(contrasts, pval=True)
+        # Quadratic reference with the same permutations of Y
+        perm_idx = np.vstack([mulm.models._shard_permutations(n, shard)
+            for shard in mulm.models._permutation_shards(nperms + 1, 8, 0)]).T
+        min_p = np.ones((px, nperms))
+        for i in xrange(py):
+            tvals_perm, _, _ = mulm.MUOLS(Y[:, i][perm_idx], X).fit().t_test(
+                contrasts)
+            tvals_perm = np.abs(tvals_perm)
+            for con in xrange(px):
+                pval_perm = np.array([np.sum(tvals_perm[con, :] >=
+                    tvals_perm[con, k]) - 1 for k in xrange(nperms)]) / \
+                    float(nperms)
+                min_p[con] = np.minimum(min_p[con], pval_perm)
+        minP_ref = np.array([[np.sum(min_p[con] <= p) / float(nperms)
+            for p in pvals[con]] for con in xrange(px)])
+        assert_almost_equal(minP, minP_ref)
+
 if __name__ == '__main__':
 
     unittest.main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the precomputed permutation sets.
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_almost_equal
+import mulm
+
+
+class TestPermutationSet(unittest.TestCase):
+
+    def test_permutations(self):
+        n = 30
+        blocks = np.repeat(["a", "b", "c"], 10)
+        perms = mulm.PermutationSet(n, 50, random_state=0, blocks=blocks)
+        assert perms.data.dtype == np.uint16
+        assert perms.data.shape == (50, n) and len(perms) == 50
+        batch = perms.batch(0, 50)
+        assert batch.dtype == np.uint16  # not upcast
+        for perm in batch:
+            assert np.all(np.sort(perm) == np.arange(n))
+            # within blocks
+            assert np.all(blocks[perm] == blocks)
+        assert len(set(map(tuple, batch))) == 50
+        assert np.all(perms[7] == batch[7])
+        # reproducible
+        assert np.all(mulm.PermutationSet(n, 50, random_state=0,
+                                          blocks=blocks).data == perms.data)
+
+    def test_sign_flips(self):
+        n = 21
+        blocks = np.arange(n) // 3
+        signs = mulm.PermutationSet(n, 40, random_state=0, blocks=blocks,
+                                    sign_flip=True)
+        assert signs.data.dtype == np.uint8
+        assert signs.data.shape == (40, 3)  # 21 bits in 3 bytes
+        batch = signs.batch(0, 40)
+        assert set(np.unique(batch)) == set([-1, 1])
+        # one sign per block
+        assert np.all(batch == batch[:, blocks * 3])
+
+    def test_save_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "perms.npy")
+            perms = mulm.PermutationSet(25, 30, random_state=1)
+            perms.save(filename)
+            loaded = mulm.PermutationSet.load(filename)
+            assert isinstance(loaded.data, np.memmap)
+            assert np.all(loaded.batch(0, 30) == perms.batch(0, 30))
+            # memory-mapped sets are pickled by filename
+            pickled = pickle.dumps(loaded)
+            assert len(pickled) < perms.data.nbytes
+            assert np.all(pickle.loads(pickled).batch(3, 9) ==
+                          perms.batch(3, 9))
+            # the same permutations for the models, whatever n_jobs
+            np.random.seed(2)
+            X = np.hstack([np.random.randn(25, 2), np.ones((25, 1))])
+            Y = np.random.randn(25, 12)
+            mod = mulm.MUOLS(Y, X).fit()
+            tvals, pvals, df = mod.t_test_maxT([1, 0, 0], perm_batch=7,
+                                               permutations=loaded)
+            tvals, pvals_jobs, df = mod.t_test_maxT(
+                [1, 0, 0], perm_batch=7, permutations=loaded, n_jobs=2)
+            assert np.all(pvals == pvals_jobs)
+            del loaded
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_maxT_minP(self):
+        n, py = 30, 15
+        np.random.seed(3)
+        X = np.hstack([np.random.randn(n, 1), np.ones((n, 1))])
+        Y = np.random.randn(n, py)
+        Y[:, :2] += X[:, :1]
+        mod = mulm.MUOLS(Y, X).fit()
+        perms = mulm.PermutationSet(n, 40, random_state=0,
+                                    blocks=np.arange(n) % 2)
+        tvals, pvals, df = mod.t_test_maxT([1, 0], perm_batch=9,
+                                           permutations=perms)
+        max_t = [np.max(np.abs(mulm.MUOLS(Y, X[perm]).fit().t_test(
+            [1, 0])[0])) for perm in perms.batch(0, 40)]
+        pvals_brute = [np.sum(np.array(max_t) >= np.abs(t)) / 40.
+                       for t in tvals[0]]
+        assert_almost_equal(pvals[0], pvals_brute)
+        # minP uses nperms + 1 permutations
+        tvals, pvals_minP, df = mod.t_test_minP([1, 0], perm_batch=9,
+                                                permutations=perms)
+        assert pvals_minP.shape == (1, py)
+        # sign flips
+        signs = mulm.PermutationSet(n, 40, random_state=0, sign_flip=True)
+        mod_one = mulm.MUOLS(Y, np.ones((n, 1))).fit()
+        tvals, pvals, df = mod_one.t_test_maxT([1], permutations=signs)
+        max_t = [np.max(np.abs(mulm.MUOLS(s[:, np.newaxis] * Y,
+                                          np.ones((n, 1))).fit().t_test(
+            [1])[0])) for s in signs.batch(0, 40)]
+        pvals_brute = [np.sum(np.array(max_t) >= np.abs(t)) / 40.
+                       for t in tvals[0]]
+        assert_almost_equal(pvals[0], pvals_brute)
+        self.assertRaises(ValueError, mod.t_test_maxT, [1, 0],
+                          permutations=mulm.PermutationSet(n + 1, 10))
+
+    def test_checkpoint(self):
+        n = 25
+        np.random.seed(4)
+        X = np.hstack([np.random.randn(n, 1), np.ones((n, 1))])
+        Y = np.random.randn(n, 10)
+        mod = mulm.MUOLS(Y, X).fit()
+        sets = [mulm.PermutationSet(n, 100, random_state=seed)
+                for seed in [0, 1]]
+        assert sets[0].digest() == mulm.PermutationSet(
+            n, 100, random_state=0).digest()
+        assert sets[0].digest() != sets[1].digest()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            checkpoint = os.path.join(tmpdir, "maxT.npz")
+            mod.t_test_maxT([1, 0], perm_batch=10, permutations=sets[0],
+                            checkpoint=checkpoint)
+            max_t, cursor, state = mulm.models._load_checkpoint(checkpoint)
+            mulm.models._save_checkpoint(checkpoint, state, max_t[:50], 50)
+            # resumed with another set
+            self.assertRaises(ValueError, mod.t_test_maxT, [1, 0],
+                              perm_batch=10, permutations=sets[1],
+                              checkpoint=checkpoint)
+            # ranges of different sets
+            filenames = list()
+            for perms, perm_range in zip(sets, [(0, 50), (50, 100)]):
+                filenames.append(os.path.join(tmpdir, "maxT_%i.npz" %
+                                              perm_range[0]))
+                mod.t_test_maxT([1, 0], perm_batch=10, permutations=perms,
+                                perm_range=perm_range,
+                                checkpoint=filenames[-1])
+            self.assertRaises(ValueError, mulm.merge_maxT, filenames)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+
+    unittest.main()
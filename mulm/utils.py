@@ -4,4 +4,399 @@ Created on Wed Sep 18 09:46:38 2013
 
 @author: jinpeng.li@cea.fr
 """
+import os
+import mmap
+import struct
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 
+
+def block_slices(dim_size, block_size):
+    """Generator that yields slice objects for indexing into
+    sequential blocks of an array along a particular axis
+    """
+    count = 0
+    while True:
+        yield slice(count, count + block_size, 1)
+        count += block_size
+        if count >= dim_size:
+            return
+
+
+def column_blocks(Y, max_cols):
+    """Slices of the sequential blocks of at most max_cols columns of Y.
+
+    When the columns of Y are contiguous (Fortran-ordered array, such as a
+    transposed (q, n) C-ordered memmap) the block boundaries are aligned on
+    memory pages whenever max_cols spans at least one page, so that each
+    block is read as whole pages.
+    """
+    p = Y.shape[1]
+    col_bytes = Y.shape[0] * Y.dtype.itemsize
+    step = mmap.PAGESIZE // gcd(col_bytes, mmap.PAGESIZE)
+    if not Y.flags.f_contiguous or Y.flags.c_contiguous or step > max_cols:
+        return list(block_slices(p, max_cols))
+    # memory pages and file pages have the same alignment
+    address = Y.ctypes.data
+    aligned = [c for c in range(step)
+               if (address + c * col_bytes) % mmap.PAGESIZE == 0]
+    if not aligned:
+        return list(block_slices(p, max_cols))
+    width = max_cols // step * step
+    bounds = [0] + list(range(aligned[0], p, width)) + [p]
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])
+            if stop > start]
+
+
+def iter_blocks(Y, max_cols, start=0, stop=None, prefetch=True):
+    """Generator that yields (slice, Y_block) for sequential blocks of
+    max_cols columns (see column_blocks()) of Y[:, start:stop]. Blocks of
+    memmaped Y are read into memory, by a background thread if prefetch is
+    True (see prefetch_blocks()): a block is then only valid until the next
+    one is requested.
+    """
+    stop = Y.shape[1] if stop is None else stop
+    slices = [slice(max(pp.start, start), min(pp.stop, stop))
+              for pp in column_blocks(Y, max_cols)
+              if pp.stop > start and pp.start < stop]
+    if isinstance(Y, np.memmap) and prefetch and len(slices) > 1:
+        for pp, Y_block in prefetch_blocks(Y, slices):
+            yield pp, Y_block
+        return
+    for pp in slices:
+        if isinstance(Y, np.memmap):
+            Y_block = Y[:, pp].copy()  # copy to force a read
+        else: Y_block = Y[:, pp]
+        yield pp, Y_block
+
+
+def iter_row_blocks(Y, max_rows, prefetch=True):
+    """Generator that yields (slice, Y_block) for sequential blocks of
+    max_rows rows of Y, contiguous reads of a C-ordered Y. As in
+    iter_blocks(), blocks of a memmaped Y are read by a background thread
+    if prefetch is True, a block being then only valid until the next one
+    is requested.
+    """
+    n = Y.shape[0]
+    slices = [slice(rows.start, min(rows.stop, n))
+              for rows in block_slices(n, max_rows)]
+    if isinstance(Y, np.memmap) and prefetch and len(slices) > 1:
+        for rows, Y_block in prefetch_blocks(Y, slices, axis=0):
+            yield rows, Y_block
+        return
+    for rows in slices:
+        if isinstance(Y, np.memmap):
+            Y_block = Y[rows].copy()  # copy to force a read
+        else: Y_block = Y[rows]
+        yield rows, Y_block
+
+
+def to_column_major(Y, filename, max_elements=2 ** 27):
+    """Write Y into the .npy file filename in Fortran order, ie. with
+    contiguous columns, and return it as a read only memmap.
+    The header of the file is padded so that the data starts on a memory
+    page, which allows column_blocks() to align the blocks on pages.
+    Y is copied by chunks of rows of at most max_elements elements, which
+    are contiguous reads of a C-ordered Y.
+
+    Example
+    -------
+    >>> import numpy as np
+    >>> from mulm.utils import to_column_major
+    >>> Y = np.load("Y.npy", mmap_mode='r')  # C-ordered
+    >>> Y = to_column_major(Y, "Y_columns.npy")
+    >>> Y.flags.f_contiguous
+    True
+    """
+    magic = np.lib.format.magic(1, 0)
+    header_len = mmap.PAGESIZE - len(magic) - 2
+    header = "{'descr': %r, 'fortran_order': True, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(Y.dtype), tuple(Y.shape))
+    with open(filename, 'wb') as fd:
+        fd.write(magic + struct.pack('<H', header_len) +
+                 (header.ljust(header_len - 1) + '\n').encode('latin1'))
+    Y_out = np.memmap(filename, dtype=Y.dtype, mode='r+',
+                      offset=mmap.PAGESIZE, shape=Y.shape, order='F')
+    max_rows = max(1, int(max_elements / Y.shape[1]))
+    for rows in block_slices(Y.shape[0], max_rows):
+        Y_out[rows] = Y[rows]
+    Y_out.flush()
+    del Y_out
+    return np.load(filename, mmap_mode='r')
+
+
+def prefetch_blocks(Y, slices, n_buffers=2, axis=1):
+    """Generator that yields (slice, Y_block) for the column slices of Y
+    (row slices if axis is 0), the blocks being read by a background thread
+    into n_buffers preallocated buffers. Block k + 1 is read while block k
+    is processed. A yielded block is only valid until the next one is
+    requested, its buffer being then recycled.
+    """
+    width = max(pp.stop - pp.start for pp in slices)
+    free = queue.Queue()
+    ready = queue.Queue()
+    for i in range(n_buffers):
+        # the first columns (rows) of a buffer are contiguous
+        if axis == 0:
+            free.put(np.empty((width, Y.shape[1]), dtype=Y.dtype))
+        else:
+            free.put(np.empty((Y.shape[0], width), dtype=Y.dtype,
+                              order='F'))
+
+    def read():
+        try:
+            for pp in slices:
+                buf = free.get()
+                if buf is None:  # the consumer stopped
+                    return
+                if axis == 0:
+                    Y_block = buf[:(pp.stop - pp.start)]
+                    Y_block[:] = Y[pp]
+                else:
+                    Y_block = buf[:, :(pp.stop - pp.start)]
+                    Y_block[:] = Y[:, pp]
+                ready.put((pp, Y_block, buf))
+        except Exception as e:
+            ready.put(e)
+            return
+        ready.put(None)
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            pp, Y_block, buf = item
+            yield pp, Y_block
+            del Y_block
+            free.put(buf)
+    finally:
+        free.put(None)
+        reader.join()
+
+
+def effective_n_jobs(n_jobs):
+    """Number of worker processes: n_jobs < 0 means cpu_count() + 1 + n_jobs
+    (-1 for all the CPUs).
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, multiprocessing.cpu_count() + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def _read_int(filename):
+    try:
+        with open(filename) as fd:
+            return int(fd.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def available_memory():
+    """Memory available to the process in bytes (None if unknown): the
+    MemAvailable of /proc/meminfo, bounded by the room left in the cgroup
+    (v2 or v1) memory limit of the process.
+    """
+    available = None
+    try:
+        with open('/proc/meminfo') as fd:
+            for line in fd:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    if available is None:
+        try:
+            available = os.sysconf('SC_AVPHYS_PAGES') * \
+                os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            pass
+    for limit_file, usage_file in [
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        limit = _read_int(limit_file)  # None for 'max'
+        usage = _read_int(usage_file)
+        if limit is not None and usage is not None:
+            room = max(0, limit - usage)
+            available = room if available is None else min(available, room)
+            break
+    return available
+
+
+def cache_size():
+    """Size in bytes of the largest (last level) CPU cache (None if
+    unknown)."""
+    sizes = list()
+    cache_dir = '/sys/devices/system/cpu/cpu0/cache'
+    try:
+        indexes = os.listdir(cache_dir)
+    except OSError:
+        return None
+    for index in indexes:
+        try:
+            with open(os.path.join(cache_dir, index, 'size')) as fd:
+                size = fd.read().strip()
+        except (IOError, OSError):
+            continue
+        units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+        if size[-1:] in units:
+            sizes.append(int(size[:-1]) * units[size[-1]])
+        elif size.isdigit():
+            sizes.append(int(size))
+    return max(sizes) if sizes else None
+
+
+def share_array(Y):
+    """Return a handle that worker processes can open with open_shared_array()
+    without pickling the data of Y.
+
+    A contiguous memmap backed by a file, or a contiguous view of one (such
+    as the transpose of a (q, n) memmap), is shared as is. Any other array
+    is dumped into a temporary .npy file that must be removed by the caller.
+
+    Return
+    ------
+    handle (filename, dtype, shape, offset, order), tmp_filename (or None)
+    """
+    tmp_filename = None
+    location = _file_location(Y)
+    if location is None:
+        fd, tmp_filename = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        np.save(tmp_filename, Y)
+        Y = np.load(tmp_filename, mmap_mode='r')
+        location = Y.filename, Y.offset
+    order = 'F' if Y.flags.f_contiguous and not Y.flags.c_contiguous else 'C'
+    handle = (location[0], Y.dtype.str, Y.shape, location[1], order)
+    return handle, tmp_filename
+
+
+def _file_location(Y):
+    """(filename, offset) of the data of Y in the file of the memmap it is
+    a view of, None if Y is not a contiguous view of a file backed memmap.
+    """
+    if not isinstance(Y, np.memmap) or \
+            not (Y.flags.c_contiguous or Y.flags.f_contiguous):
+        return None
+    base = Y
+    while isinstance(base, np.memmap) and \
+            not isinstance(base.base, mmap.mmap):
+        base = base.base
+    if not isinstance(base, np.memmap) or base.filename is None:
+        return None
+    # the data of base starts at its offset in the file
+    return base.filename, base.offset + Y.ctypes.data - base.ctypes.data
+
+
+def open_shared_array(handle):
+    """Open (read only) an array shared with share_array()."""
+    filename, dtype, shape, offset, order = handle
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order=order)
+
+
+def _call_shared(args):
+    func, handle, task = args
+    return func(open_shared_array(handle), *task)
+
+
+def map_shared(func, Y, tasks, n_jobs=1):
+    """Return [func(Y, *task) for task in tasks], the tasks being run by a
+    pool of n_jobs processes. Y is shared with the workers as a memmap (see
+    share_array()). func must be a module-level function.
+    """
+    n_jobs = effective_n_jobs(n_jobs)
+    if n_jobs == 1 or len(tasks) <= 1:
+        return [func(Y, *task) for task in tasks]
+    handle, tmp_filename = share_array(Y)
+    pool = multiprocessing.Pool(min(n_jobs, len(tasks)))
+    try:
+        return pool.map(_call_shared,
+                        [(func, handle, task) for task in tasks])
+    finally:
+        pool.close()
+        pool.join()
+        if tmp_filename is not None:
+            os.remove(tmp_filename)
+
+
+class LRUCache:
+    """Mapping of at most maxsize items, the least recently used item being
+    evicted first. hits and misses count the lookups by get().
+
+    If maxbytes is given, the items also add up to at most maxbytes bytes,
+    sizeof(value) being the size of an item. An item larger than maxbytes
+    is not cached.
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.currbytes = 0
+        self._items = OrderedDict()
+        self._sizes = dict()
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self._items.pop(key)
+        self._items[key] = value  # most recently used
+        return value
+
+    def put(self, key, value):
+        if key in self._items:
+            del self._items[key]
+            self.currbytes -= self._sizes.pop(key)
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        self._items[key] = value
+        self._sizes[key] = size
+        self.currbytes += size
+        while len(self._items) > self.maxsize or \
+                (self.maxbytes is not None and
+                 self.currbytes > self.maxbytes):
+            key, _ = self._items.popitem(last=False)
+            self.currbytes -= self._sizes.pop(key)
+
+    def clear(self):
+        self._items.clear()
+        self._sizes.clear()
+        self.currbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def info(self):
+        """dict of hits, misses, maxsize, currsize, maxbytes and
+        currbytes."""
+        return dict(hits=self.hits, misses=self.misses,
+                    maxsize=self.maxsize, currsize=len(self._items),
+                    maxbytes=self.maxbytes, currbytes=self.currbytes)